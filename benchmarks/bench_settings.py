@@ -0,0 +1,8 @@
+"""Settings for the benchmarks; run.py points ES_HOSTS at a fake ES."""
+import os
+
+ES_HOSTS = [os.environ.get('ES_BENCH_HOST', '127.0.0.1:9200')]
+ES_INDEXES = {'default': 'bench'}
+ES_DISABLED = False
+ES_TIMEOUT = 10
+ES_RETRIES = 0
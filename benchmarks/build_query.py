@@ -0,0 +1,63 @@
+"""
+Compares compiling long S chains with memoized compilation against
+compiling every step from scratch, the way S._build_query used to.
+
+Run from the repository root::
+
+    DJANGO_SETTINGS_MODULE=es_settings python benchmarks/build_query.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from elasticutils import F, S
+
+
+class Meta(object):
+    db_table = 'bench'
+
+
+class Model(object):
+    _meta = Meta()
+
+
+def chain(length):
+    s = S(Model).query(title__text='taco trucks')
+    s = s.facet(styles={'terms': {'field': 'style'}})
+    for i in range(length):
+        s = s.filter(F(category=i) | F(tag=i))
+    return s.order_by('-created')
+
+
+def from_scratch(s):
+    """Returns a copy of `s` that has to compile all of its steps again."""
+    new = S(s.type)
+    new.steps = s.steps
+    return new
+
+
+def paginate(s, fresh):
+    # What a template with a paginator does: count, then render one page.
+    for i in range(10):
+        page = s[i * 20:(i + 1) * 20]
+        (from_scratch(page) if fresh else page)._build_query()
+        (from_scratch(s[:0]) if fresh else s[:0])._build_query()
+
+
+def main():
+    print('%8s %12s %12s %8s' % ('steps', 'scratch', 'memoized', 'speedup'))
+    for length in (5, 20, 100, 500):
+        s = chain(length)
+        s._build_query()
+        number = max(1, 2000 / length)
+        scratch = timeit.timeit(lambda: paginate(s, True), number=number)
+        memo = timeit.timeit(lambda: paginate(s, False), number=number)
+        print('%8d %10.2fms %10.2fms %7.1fx' % (
+            length, scratch * 1000 / number, memo * 1000 / number,
+            scratch / memo))
+
+
+if __name__ == '__main__':
+    main()
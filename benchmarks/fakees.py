@@ -0,0 +1,208 @@
+"""
+A stand-in for ElasticSearch that answers searches, ``_msearch`` and
+``_bulk`` requests with canned responses after a configurable delay, so
+benchmarks measure ElasticUtils rather than a cluster.
+
+Like a node with ``http.compression`` enabled it accepts and sends gzipped
+bodies, and searches honour ``fields``, ``_source`` include/exclude,
+``filter_path`` and terms facets, so the size of responses is realistic.
+
+It runs in its own process, so its work doesn't compete with the code being
+measured for the GIL.  Run it on its own with::
+
+    python benchmarks/fakees.py 9250 --latency 5
+"""
+import json
+import optparse
+import socket
+import time
+import urlparse
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from fnmatch import fnmatch
+from multiprocessing import Process
+from SocketServer import ThreadingMixIn
+
+
+def search_response(size):
+    """Returns a search response with `size` hits."""
+    hits = [{'_index': 'bench', '_type': 'bench', '_id': str(i),
+             '_score': 1.0,
+             '_source': {'id': i, 'title': 'Taco truck %d' % i,
+                         'style': 'korean', 'price': i % 7,
+                         'created': '2012-03-01T12:00:00'}}
+            for i in range(size)]
+    return {'took': 3, 'timed_out': False,
+            '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+            'hits': {'total': 10000, 'max_score': 1.0, 'hits': hits}}
+
+
+def terms_facet(size):
+    return {'_type': 'terms', 'missing': 0, 'total': 10000, 'other': 0,
+            'terms': [{'term': 'term %d' % i, 'count': 1000 - i}
+                      for i in range(size)]}
+
+
+def trim(data, paths):
+    """Keeps only what's at the dotted `paths` of `data`, like filter_path."""
+    if isinstance(data, list):
+        return [trim(item, paths) for item in data]
+    if not isinstance(data, dict):
+        return data
+    rv = {}
+    for key, value in data.items():
+        below = [p[len(key) + 1:] for p in paths if p.startswith(key + '.')]
+        if key in paths:
+            rv[key] = value
+        elif below:
+            value = trim(value, below)
+            if value:
+                rv[key] = value
+    return rv
+
+
+def select_source(source, include, exclude):
+    return dict((k, v) for k, v in source.items()
+                if (not include or [p for p in include if fnmatch(k, p)]) and
+                not [p for p in exclude if fnmatch(k, p)])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately; don't let Nagle's
+        # algorithm hold the body back until the client's delayed ACK.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        body = self.read_body()
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        time.sleep(self.server.latency)
+        if '/_bulk' in self.path:
+            data = self.bulk(body)
+        elif '/_msearch' in self.path:
+            response = self.search('{}')
+            data = '{"responses":[%s]}' % ','.join(
+                [response] * (body.count('\n') // 2))
+        elif '_search' in self.path:
+            params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            data = self.search(body, params.get('filter_path', [''])[0])
+        else:
+            data = '{"ok":true}'
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return ''.join(chunks)
+
+    def search(self, body, filter_path=''):
+        cache = self.server.responses
+        if (body, filter_path) not in cache:
+            query = json.loads(body or '{}')
+            response = search_response(query.get('size', 10))
+            source = query.get('_source') or {}
+            for hit in response['hits']['hits']:
+                if 'fields' in query:
+                    fields = query['fields']
+                    doc = hit.pop('_source')
+                    if fields:
+                        hit['fields'] = dict((f, doc.get(f)) for f in fields)
+                elif source:
+                    hit['_source'] = select_source(
+                        hit['_source'], source.get('include', []),
+                        source.get('exclude', []))
+            if query.get('facets'):
+                response['facets'] = dict(
+                    (name, terms_facet(facet.get('terms', {}).get('size', 10)))
+                    for name, facet in query['facets'].items())
+            if filter_path:
+                response = trim(response, filter_path.split(','))
+            cache[body, filter_path] = json.dumps(response)
+        return cache[body, filter_path]
+
+    def bulk(self, body):
+        # Counting action lines is enough; parsing them would make the
+        # server the bottleneck.
+        items = []
+        for line in body.splitlines():
+            for action in ('index', 'delete'):
+                if line.startswith('{"%s"' % action):
+                    items.append('{"%s":{"ok":true}}' % action)
+        return '{"took":1,"items":[%s]}' % ','.join(items)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.responses = {}
+
+
+def free_port(ports=range(9299, 9249, -1)):
+    """
+    Returns a free port.  pyes only speaks HTTP to ports starting with 92.
+    """
+    for port in ports:
+        sock = socket.socket()
+        try:
+            sock.bind(('127.0.0.1', port))
+        except socket.error:
+            continue
+        finally:
+            sock.close()
+        return port
+    raise RuntimeError('No free port in 9250-9299.')
+
+
+def start(port, latency=0):
+    """Starts a server in a child process and returns the process."""
+    process = Process(target=serve, args=(port, latency))
+    process.daemon = True
+    process.start()
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('The fake ElasticSearch did not start.')
+
+
+def serve(port, latency=0):
+    Server(port, latency).serve_forever()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog PORT [--latency MS]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='Milliseconds to wait before answering.')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Give the port to listen on.')
+    serve(int(args[0]), options.latency / 1000)
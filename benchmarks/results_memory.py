@@ -0,0 +1,81 @@
+"""
+Measures the memory held by the results of a 10,000 hit search, for the
+way SearchResults used to build them (every row converted up front, next to
+the full raw response) and for the lazy results.
+
+Run from the repository root::
+
+    DJANGO_SETTINGS_MODULE=es_settings python benchmarks/results_memory.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from elasticutils import DictSearchResults, ListSearchResults
+
+HITS = 10000
+
+
+class Meta(object):
+    db_table = 'bench'
+
+
+class Model(object):
+    _meta = Meta()
+
+
+def make_response(key):
+    hits = [{'_index': 'bench', '_type': 'bench', '_id': str(i),
+             '_score': 1.0,
+             key: {'id': i, 'title': 'Taco truck %d' % i, 'style': 'korean',
+                   'price': i % 7}}
+            for i in range(HITS)]
+    return {'took': 5, 'hits': {'total': HITS, 'max_score': 1.0,
+                                'hits': hits}}
+
+
+def size(obj, seen=None):
+    """Returns the bytes used by `obj` and everything it refers to."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    rv = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        rv += sum(size(k, seen) + size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        rv += sum(size(v, seen) for v in obj)
+    elif hasattr(obj, '__dict__'):
+        rv += size(obj.__dict__, seen)
+    return rv
+
+
+def eager(cls, response, fields):
+    """Holds the raw response and a converted list, like before."""
+    results = cls(Model, response, fields)
+    rows = [results.convert(hit) for hit in response['hits']['hits']]
+    return response, rows
+
+
+def main():
+    print('%-18s %12s %12s %12s %10s' % ('results', 'eager', 'lazy',
+                                         'objects', 'iterate'))
+    for cls, key, fields in ((ListSearchResults, 'fields', ['id', 'title']),
+                             (DictSearchResults, '_source', [])):
+        eager_size = size(eager(cls, make_response(key), fields))
+        lazy = cls(Model, make_response(key), fields)
+        lazy_size = size(lazy)
+        # The response is gone once the caller stops referring to it.
+        materialized = cls(Model, make_response(key), fields)
+        materialized.objects
+        objects_size = size(materialized)
+        elapsed = timeit.timeit(lambda: list(lazy), number=10) / 10
+        print('%-18s %10.1fMB %10.1fMB %10.1fMB %8.1fms' % (
+            cls.__name__, eager_size / 1e6, lazy_size / 1e6,
+            objects_size / 1e6, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
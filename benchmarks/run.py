@@ -0,0 +1,236 @@
+"""
+Measures ElasticUtils' own overhead against a fake ElasticSearch (see
+fakees.py) and compares it to the baselines stored in baselines.json.
+
+Run from the repository root::
+
+    python benchmarks/run.py                 # compare to the baselines
+    python benchmarks/run.py search bulk     # only benchmarks named so
+    python benchmarks/run.py --save          # store new baselines
+    python benchmarks/run.py --latency 5     # answer after 5ms
+
+It exits with status 1 if a benchmark got slower than its baseline by more
+than the tolerance.  Baselines depend on the machine, so store them on the
+machine you compare on.
+"""
+import json
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'bench_settings'
+
+import fakees
+from build_query import chain, paginate
+
+from elasticutils import (DictSearchResults, F, ListSearchResults,
+                          ObjectSearchResults, S, execute_many)
+from elasticutils.bulk import BulkIndexer
+from elasticutils.models import SearchMixin
+
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+BENCHMARKS = []
+
+
+class Meta(object):
+    db_table = 'bench'
+
+
+class Manager(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def filter(self, id__in=None):
+        ids = set(id__in)
+        return [obj for obj in self.objects if obj.id in ids]
+
+
+class Model(SearchMixin):
+    _meta = Meta()
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+    @classmethod
+    def from_source(cls, source):
+        return cls(**source)
+
+    def fields(self):
+        return {'id': self.id, 'title': self.title, 'style': 'korean'}
+
+Model.objects = Manager([Model(id=i, title='Taco truck %d' % i)
+                         for i in range(1000)])
+
+
+def benchmark(number):
+    """Registers a function returning the callable to time `number` times."""
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, setup, number))
+        return setup
+    return register
+
+
+@benchmark(number=20)
+def build_query_memoized():
+    s = chain(100)
+    s._build_query()
+    return lambda: paginate(s, False)
+
+
+@benchmark(number=5)
+def build_query_scratch():
+    s = chain(100)
+    return lambda: paginate(s, True)
+
+
+@benchmark(number=1000)
+def f_compose():
+    def compose():
+        f = F(style='korean')
+        for i in range(20):
+            f = f | F(tag=i)
+        return ~(f & F(price__lt=5))
+    return compose
+
+
+@benchmark(number=5)
+def f_compose_large():
+    def compose():
+        f = F(style='korean')
+        for i in range(4000):
+            f = f | F(tag=i) | F(price__gt=i)
+        return f.filters
+    return compose
+
+
+def hits_response(key):
+    raw = fakees.search_response(1000)
+    if key == 'fields':
+        for hit in raw['hits']['hits']:
+            hit['fields'] = hit.pop('_source')
+    return raw
+
+
+@benchmark(number=50)
+def results_dict():
+    raw = hits_response('_source')
+    return lambda: list(DictSearchResults(Model, raw, []))
+
+
+@benchmark(number=50)
+def results_list():
+    raw = hits_response('fields')
+    return lambda: list(ListSearchResults(Model, raw, ['id', 'title']))
+
+
+@benchmark(number=20)
+def results_objects():
+    raw = hits_response('_source')
+    return lambda: list(ObjectSearchResults(Model, raw, ['id']))
+
+
+@benchmark(number=20)
+def results_objects_from_source():
+    raw = hits_response('_source')
+    return lambda: list(ObjectSearchResults(Model, raw, [],
+                                            {'source': True}))
+
+
+@benchmark(number=200)
+def search():
+    return lambda: S(Model).filter(style='korean')[:20].raw()
+
+
+@benchmark(number=100)
+def search_msearch():
+    return lambda: execute_many([S(Model).filter(tag=i)[:10]
+                                 for i in range(5)])
+
+
+@benchmark(number=3)
+def bulk():
+    def index():
+        indexer = BulkIndexer(max_docs=500)
+        for i in range(5000):
+            indexer.index('bench', 'bench', i,
+                          {'id': i, 'title': 'Taco truck %d' % i})
+        indexer.close()
+    return index
+
+
+@benchmark(number=10)
+def bulk_index_objects():
+    try:
+        from elasticutils.tasks import index_objects
+    except ImportError as e:
+        print('bulk_index_objects skipped: %s' % e)
+        return None
+    ids = range(1000)
+    return lambda: index_objects(Model, ids)
+
+
+def measure(f, number, repeat=5):
+    """Returns the best time in seconds of one call to `f`."""
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [name ...]')
+    parser.add_option('--save', action='store_true', default=False,
+                      help='Store the results as the new baselines.')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='Allowed slowdown before failing, 0.25 is 25%.')
+    parser.add_option('--latency', type='float', default=0,
+                      help='Milliseconds the fake ElasticSearch waits.')
+    options, names = parser.parse_args()
+
+    port = fakees.free_port()
+    os.environ['ES_BENCH_HOST'] = '127.0.0.1:%d' % port
+    fakees.start(port, options.latency / 1000)
+
+    stored = {}
+    if os.path.exists(BASELINES):
+        stored = json.load(open(BASELINES))
+    # Baselines taken with another latency can't be compared.
+    baselines = {}
+    if stored.get('latency', 0) == options.latency:
+        baselines = stored.get('results', {})
+
+    results, slower = {}, []
+    print('%-30s %12s %12s %8s' % ('benchmark', 'time', 'baseline', 'change'))
+    for name, setup, number in BENCHMARKS:
+        if names and not [n for n in names if n in name]:
+            continue
+        f = setup()
+        if f is None:
+            continue
+        f()  # Warm up caches, connections and the fake's responses.
+        results[name] = elapsed = measure(f, number)
+        line = '%-30s %10.3fms' % (name, elapsed * 1000)
+        if name in baselines:
+            change = elapsed / baselines[name] - 1
+            line += ' %10.3fms %+7.0f%%' % (baselines[name] * 1000,
+                                            change * 100)
+            if change > options.tolerance:
+                line += ' SLOWER'
+                slower.append(name)
+        print(line)
+
+    if options.save:
+        stored = {'latency': options.latency,
+                  'python': sys.version.split()[0],
+                  'results': dict(baselines, **results)}
+        with open(BASELINES, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+        print('Saved %d baselines to %s.' % (len(results), BASELINES))
+    elif slower:
+        print('Slower than the baselines: %s' % ', '.join(slower))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
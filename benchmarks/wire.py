@@ -0,0 +1,95 @@
+"""
+Measures the bytes sent and received for typical requests against the fake
+ElasticSearch (see fakees.py), as they are, with trimmed responses
+(``S.source`` and ``S.filter_path``), gzipped (``ES_COMPRESS``) and both.
+
+Run from the repository root::
+
+    python benchmarks/wire.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'bench_settings'
+
+import fakees
+
+import elasticutils
+from elasticutils import S
+from elasticutils.bulk import BulkIndexer
+from elasticutils.pool import ConnectionPool
+
+
+class Meta(object):
+    db_table = 'bench'
+
+
+class Model(object):
+    _meta = Meta()
+
+
+def search_docs(trimmed):
+    s = S(Model).values_dict()[:100]
+    if trimmed:
+        s = s.source(include=['id', 'title']).filter_path()
+    s.raw()
+
+
+def search_objects(trimmed):
+    s = S(Model).filter(style='korean')[:20]
+    if trimmed:
+        s = s.filter_path()
+    s.raw()
+
+
+def facets(trimmed):
+    s = S(Model).facet(tags={'terms': {'field': 'tag', 'size': 200}},
+                       styles={'terms': {'field': 'style', 'size': 50}})
+    if trimmed:
+        s = s.filter_path()
+    s.raw_facets()
+
+
+def bulk(trimmed):
+    indexer = BulkIndexer(max_docs=500)
+    for i in range(5000):
+        indexer.index('bench', 'bench', i,
+                      {'id': i, 'title': 'Taco truck %d' % i,
+                       'style': 'korean', 'price': i % 7})
+    indexer.close()
+
+
+SCENARIOS = [('search 100 docs', search_docs),
+             ('search 20 objects', search_objects),
+             ('facets', facets),
+             ('bulk 5000 docs', bulk)]
+
+
+def measure(scenario, trimmed, compress):
+    """Returns the bytes sent and received by one run of `scenario`."""
+    pool = ConnectionPool([os.environ['ES_BENCH_HOST']], compress=compress)
+    elasticutils.get_es().connection = pool
+    scenario(trimmed)
+    stats = pool.stats()[0]
+    return stats['bytes_sent'] + stats['bytes_received']
+
+
+def main():
+    port = fakees.free_port()
+    os.environ['ES_BENCH_HOST'] = '127.0.0.1:%d' % port
+    fakees.start(port)
+
+    modes = [('plain', False, False), ('trimmed', True, False),
+             ('gzip', False, True), ('both', True, True)]
+    print('%-20s' % 'bytes on wire' +
+          ''.join('%12s' % name for name, t, c in modes))
+    for name, scenario in SCENARIOS:
+        sizes = [measure(scenario, trimmed, compress)
+                 for mode, trimmed, compress in modes]
+        print('%-20s' % name + ''.join('%10.1fKB' % (size / 1024.0)
+                                       for size in sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,23 @@
+import json
 import logging
+import time
+import weakref
 from functools import wraps
-from threading import local
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
 from operator import itemgetter
 
 from pyes import ES, exceptions
-from pyes.es import thrift_enable
+from pyes.convert_errors import raise_if_error
+from pyes.es import ESJsonEncoder, Method, RestRequest, thrift_enable
 
-try:
-    from statsd import statsd
-except ImportError:
-    statsd = None
+from elasticutils.breaker import BudgetExceeded, deadline, with_retries
+from elasticutils.cache import cache_key, get_result_cache
+from elasticutils import instrumentation
+from elasticutils.identity import get_identity_map
+from elasticutils.pool import ConnectionPool, get_connection_pool
+from elasticutils.serializers import get_serializer
+from elasticutils.singleflight import get_single_flight
 
 try:
     from django.conf import settings
@@ -17,11 +25,88 @@ except ImportError:
     import es_settings as settings
 
 
+# Errors that mean ElasticSearch can't serve a request right now.  Failed
+# connections are raised by the pool as ConnectionFailed, an
+# ElasticSearchException.
+UNAVAILABLE_ERRORS = (exceptions.ElasticSearchException,
+                      exceptions.NoServerAvailable, BudgetExceeded)
+
 _local = local()
 _local.disabled = {}
+_pool = None
+_pool_lock = Lock()
 log = logging.getLogger('elasticsearch')
 
 
+class ElasticSearch(ES):
+    """
+    A pyes `ES` that encodes requests and decodes responses with the
+    ``ES_SERIALIZER`` serializer instead of the json module.
+
+    A body can also be a list of strings; the connection pool streams it
+    instead of joining it into one string first.
+    """
+
+    def search(self, query, indexes=None, doc_types=None, **query_params):
+        # pyes encodes dict queries with the json module before they get to
+        # _send_request; hand them over as they are instead.
+        if isinstance(query, dict):
+            return self._query_call('_search', query, indexes, doc_types,
+                                    **query_params)
+        return super(ElasticSearch, self).search(query, indexes, doc_types,
+                                                 **query_params)
+
+    def _send_request(self, method, path, body=None, params=None):
+        if not path.startswith('/'):
+            path = '/' + path
+        if not self.connection:
+            self._init_connection()
+        serializer = get_serializer()
+        if not body:
+            body = ''
+        elif isinstance(body, dict):
+            body = serializer.dumps(body)
+        elif isinstance(body, list) and (
+                self.dump_curl is not None or
+                not isinstance(self.connection, ConnectionPool)):
+            body = ''.join(body)
+        request = RestRequest(method=Method._NAMES_TO_VALUES[method.upper()],
+                              uri=path, parameters=params or {}, headers={},
+                              body=body)
+        if self.dump_curl is not None:
+            self._dump_curl_request(request)
+        start = time.time()
+        response = self.connection.execute(request)
+        received = time.time()
+        try:
+            decoded = serializer.loads(response.body)
+        except ValueError:
+            # E.g. no handler was found for the URI; the body says so.
+            raise exceptions.ElasticSearchException(
+                response.body, response.status, response.body)
+        if instrumentation.enabled('request'):
+            instrumentation.emit(
+                'request', method=method, path=path, status=response.status,
+                elapsed=received - start, response_bytes=len(response.body),
+                request_bytes=(sum(len(part) for part in body)
+                               if isinstance(body, list) else len(body)))
+        instrumentation.emit('decode', bytes=len(response.body),
+                             elapsed=time.time() - received)
+        if response.status != 200:
+            raise_if_error(response.status, decoded)
+        return decoded
+
+
+def stream_body(es, parts):
+    """
+    Returns the list of strings `parts` as a request body for `es`: as is if
+    `es` can stream it, joined into one string otherwise.
+    """
+    if isinstance(es, ElasticSearch):
+        return parts
+    return ''.join(parts)
+
+
 def get_es():
     """Return one es object."""
     if not hasattr(_local, 'es'):
@@ -32,12 +117,37 @@ def get_es():
             raise ValueError('ES_HOSTS is not set to a valid port starting '
                              'with 9200-9299 range. Other ports are valid '
                              'if using pythrift.')
-        _local.es = ES(settings.ES_HOSTS,
-                       default_indexes=[settings.ES_INDEXES['default']],
-                       timeout=timeout, dump_curl=dump)
+        _local.es = ElasticSearch(
+            settings.ES_HOSTS,
+            default_indexes=[settings.ES_INDEXES['default']],
+            timeout=timeout, dump_curl=dump)
+        if (getattr(settings, 'ES_POOL', True) and
+            settings.ES_HOSTS[0].split(':')[1].startswith('92')):
+            _local.es.connection = get_connection_pool()
     return _local.es
 
 
+def get_pool():
+    """
+    Returns the thread pool that runs searches in the background, with
+    `ES_THREADS` threads.  Each thread uses its own `ES` from get_es().
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPool(getattr(settings, 'ES_THREADS', 4))
+    return _pool
+
+
+def get_index(doc_type):
+    """
+    Returns the name of the index (or alias) that `doc_type` is stored in,
+    according to `ES_INDEXES`.
+    """
+    return settings.ES_INDEXES.get(doc_type) or settings.ES_INDEXES['default']
+
+
 def es_required(f):
     @wraps(f)
     def wrapper(*args, **kw):
@@ -58,7 +168,9 @@ def es_required_or_50x(disabled_msg, error_msg):
 
     If `ES_DISABLED` is `True` then we raise a 501 Not Implemented and display
     the disabled_msg.  If we try the view and an ElasticSearch exception is
-    raised we raise a 503 error with the error_msg.
+    raised, no node is available or the connection fails, we raise a 503
+    error with the error_msg.  While the circuit breaker is open this happens
+    without waiting on ElasticSearch.
 
     We use user-supplied templates in elasticutils/501.html and
     elasticutils/503.html.
@@ -75,7 +187,7 @@ def es_required_or_50x(disabled_msg, error_msg):
             else:
                 try:
                     return f(request, *args, **kw)
-                except exceptions.ElasticSearchException as error:
+                except UNAVAILABLE_ERRORS as error:
                     response = render(request, 'elasticutils/503.html',
                             {'msg': error_msg, 'error': error})
                     response.status_code = 503
@@ -112,34 +224,186 @@ def _process_filters(filters):
     return rv
 
 
+_KEYED_FILTERS = frozenset(['term', 'terms', 'in', 'range'])
+
+
+def _term_values(clause):
+    """
+    Returns ``(field, values)`` if `clause` is a plain term or in filter,
+    and ``(None, None)`` otherwise.
+    """
+    if len(clause) == 1:
+        kind, body = next(iter(clause.items()))
+        if kind in ('term', 'terms', 'in') and len(body) == 1:
+            field, value = next(iter(body.items()))
+            if kind == 'term':
+                return field, [value]
+            elif isinstance(value, (list, tuple)):
+                return field, list(value)
+    return None, None
+
+
+def _clause_key(clause):
+    """
+    Returns a cheap hashable key telling duplicates of the filter `clause`
+    apart: ``(kind, field, value)`` for term, in and range filters on one
+    field, and None for anything else.
+    """
+    if len(clause) == 1:
+        kind, body = next(iter(clause.items()))
+        if (kind in _KEYED_FILTERS and isinstance(body, dict) and
+                len(body) == 1):
+            field, value = next(iter(body.items()))
+            if isinstance(value, dict):
+                value = tuple(sorted(value.items()))
+            elif isinstance(value, list):
+                value = tuple(value)
+            try:
+                hash(value)
+            except TypeError:
+                pass
+            else:
+                # The type keeps 1 and True apart, as JSON does.
+                return kind, field, type(value), value
+    return None
+
+
+def _json_key(clause):
+    """Returns the filter `clause` as sorted JSON, for any other clause."""
+    return json.dumps(clause, sort_keys=True, cls=ESJsonEncoder)
+
+
+def _cache_filter(clause, cache=True, key=None):
+    """
+    Returns a copy of the filter `clause` telling ElasticSearch whether to
+    cache it, and under which `key`.
+    """
+    kind, body = list(clause.items())[0]
+    if kind in ('and', 'or') and isinstance(body, list):
+        body = {'filters': body}
+    body = dict(body, _cache=cache)
+    if key:
+        body['_cache_key'] = key
+    return {kind: body}
+
+
+def _merge_filters(clauses, conn):
+    """
+    Returns the filter joining `clauses` with `conn`, without duplicate
+    clauses.  OR'd term and in filters on the same field become one in
+    filter.
+    """
+    rv, seen, values, seen_values = [], set(), {}, {}
+    # The first clause of each kind without a cheap key.  JSON is slow, so
+    # it's only used once there are two clauses that might be duplicates.
+    unkeyed = {}
+    for clause in clauses:
+        field, vals = _term_values(clause) if conn == 'or' else (None, None)
+        if field is not None:
+            if field not in values:
+                values[field], seen_values[field] = [], set()
+                # Filled in below, where the first one was.
+                rv.append((field,))
+            for value in vals:
+                try:
+                    if value in seen_values[field]:
+                        continue
+                    seen_values[field].add(value)
+                except TypeError:
+                    pass
+                values[field].append(value)
+            continue
+        key = _clause_key(clause)
+        if key is None:
+            kind = frozenset(clause)
+            if kind not in unkeyed:
+                unkeyed[kind] = clause
+                rv.append(clause)
+                continue
+            if unkeyed[kind] is not None:
+                seen.add(_json_key(unkeyed[kind]))
+                unkeyed[kind] = None
+            key = _json_key(clause)
+        if key not in seen:
+            seen.add(key)
+            rv.append(clause)
+    for i, clause in enumerate(rv):
+        if isinstance(clause, tuple):
+            field = clause[0]
+            if len(values[field]) == 1:
+                rv[i] = {'term': {field: values[field][0]}}
+            else:
+                rv[i] = {'in': {field: values[field]}}
+    if len(rv) == 1:
+        return rv[0]
+    return {conn: rv}
+
+
 class F(object):
     """
-    Filter objects.
+    Filter objects.  They are immutable: combining them returns a new F.
     """
     def __init__(self, **filters):
+        # A combined F only keeps the two Fs it joins with `_conn`.  The tree
+        # is flattened and merged into `filters` once, when that's used, so
+        # composing many Fs in a loop takes linear time.
+        self._conn, self._parts, self._filters = None, (), {}
         if filters:
             items = _process_filters(filters.items())
             if len(items) > 1:
-                self.filters = {'and': items }
+                self._filters = {'and': items }
             else:
-                self.filters = items[0]
-        else:
-            self.filters = {}
+                self._filters = items[0]
+
+    @property
+    def filters(self):
+        if self._filters is None:
+            self._filters = _merge_filters(self._clauses(self._conn),
+                                           self._conn)
+        return self._filters
+
+    @filters.setter
+    def filters(self, value):
+        self._conn, self._parts = None, ()
+        self._filters = value
+
+    def _clauses(self, conn):
+        """Returns the clauses this F contributes to a `conn` of filters."""
+        rv, stack = [], [self]
+        while stack:
+            f = stack.pop()
+            if f._parts and f._conn == conn:
+                # Flatten (a | b) | c into a single list.
+                stack.extend(reversed(f._parts))
+                continue
+            filters = f._filters
+            if filters is None:
+                filters = f.filters
+            if (len(filters) == 1 and conn in filters and
+                isinstance(filters[conn], list)):
+                rv.extend(filters[conn])
+            elif filters:
+                rv.append(filters)
+        return rv
 
     def _combine(self, other, conn='and'):
         """
         OR and AND will create a new F, with the filters from both F objects
-        combined with the connector `conn`.
+        combined with the connector `conn`.  Neither F is modified.
         """
         f = F()
-        if conn in self.filters:
-            f.filters = self.filters
-            f.filters[conn].append(other.filters)
-        elif conn in other.filters:
-            f.filters = other.filters
-            f.filters[conn].append(self.filters)
-        else:
-            f.filters = {conn: [self.filters, other.filters]}
+        f._conn, f._parts, f._filters = conn, (self, other), None
+        return f
+
+    def filter_cache(self, cache=True, key=None):
+        """
+        Returns a new F telling ElasticSearch whether to cache the result of
+        this filter, and optionally the `key` to cache it under.  Keys keep
+        the cache entries of big filters small.
+        """
+        f = F()
+        if self.filters:
+            f.filters = _cache_filter(self.filters, cache, key)
         return f
 
     def __or__(self, other):
@@ -161,6 +425,16 @@ class F(object):
 # Number of results to show before truncating when repr(S)
 REPR_OUTPUT_SIZE = 20
 
+# What S._compile starts from: a query without any steps.
+_EMPTY_STATE = {'filters': (), 'queries': (), 'sort': (), 'fields': ('id',),
+                'facets': {}, 'as_list': False, 'as_dict': False,
+                'hydrate': {}, 'filter_cache': None, 'source': None,
+                'post_filter': False}
+
+# What filter_path always keeps: what SearchResults and S read.
+_NEEDED_PATHS = ('took', 'hits.total', 'hits.hits._id', 'hits.hits.fields',
+                 'hits.hits._source', 'facets')
+
 
 class S(object):
     """
@@ -169,11 +443,25 @@ class S(object):
     """
     def __init__(self, type_):
         self.type = type_
-        self.steps = []
+        self.steps = ()
         self.start = 0
         self.stop = None
         self.as_list = self.as_dict = False
         self._results_cache = None
+        # Results of a search for facets only, see raw_facets().
+        self._facets_cache = None
+        self._cache_timeout = None
+        self._timeout = None
+        self._filter_path = None
+        # The result sets of clones that only differ in their slice, so any
+        # of them can reuse the total and facets found by another.  They're
+        # held weakly: nothing is reused once the results are gone, so a
+        # long-lived S doesn't keep answering with an old total.
+        self._shared = weakref.WeakSet()
+        # The S this one was cloned from, until our steps are compiled.
+        self._base = None
+        self._compiled = None
+        self._query = None
 
     def __repr__(self):
         data = list(self)[:REPR_OUTPUT_SIZE + 1]
@@ -183,11 +471,17 @@ class S(object):
 
     def _clone(self, next_step=None):
         new = self.__class__(self.type)
-        new.steps = list(self.steps)
+        new.steps = self.steps
         if next_step:
-            new.steps.append(next_step)
+            new.steps += (next_step,)
+        new._base = self
+        if not next_step:
+            new._shared = self._shared
         new.start = self.start
         new.stop = self.stop
+        new._cache_timeout = self._cache_timeout
+        new._timeout = self._timeout
+        new._filter_path = self._filter_path
         return new
 
     def values(self, *fields):
@@ -204,6 +498,33 @@ class S(object):
         """
         return self._clone(next_step=('values_dict', fields))
 
+    def hydrate(self, source=False, select_related=(), only=()):
+        """
+        Returns a new S instance that changes how model instances are loaded
+        for the results.
+
+        With `source` they are built from the indexed documents by the
+        model's ``from_source`` classmethod, without touching the database.
+        Otherwise `select_related` and `only` are applied to the query
+        fetching them; ``select_related=True`` follows every relation.
+        """
+        return self._clone(next_step=('hydrate', (
+            ('source', source),
+            ('select_related', select_related is True or
+             tuple(select_related)),
+            ('only', tuple(only)))))
+
+    def source(self, include=(), exclude=()):
+        """
+        Returns a new S instance whose hits only carry the fields of their
+        ``_source`` matching the `include` patterns and not the `exclude`
+        ones, e.g. ``source(exclude=['body'])``.  This trims the results of
+        ``values_dict()`` without fields and of ``hydrate(source=True)``.
+        Needs ElasticSearch 1.0.
+        """
+        return self._clone(next_step=('source', (tuple(include),
+                                                 tuple(exclude))))
+
     def order_by(self, *fields):
         """
         Returns a new S instance with the ordering changed.
@@ -215,21 +536,41 @@ class S(object):
         Returns a new S instance with the query args combined to the existing
         set.
         """
-        return self._clone(next_step=('query', kw.items()))
+        return self._clone(next_step=('query', tuple(kw.items())))
 
     def filter(self, *filters, **kw):
         """
         Returns a new S instance with the filter args combined to the existing
         set.
         """
-        return self._clone(next_step=('filter', list(filters) + kw.items()))
+        return self._clone(next_step=('filter',
+                                      tuple(filters) + tuple(kw.items())))
+
+    def filter_cache(self, cache=True, key=None):
+        """
+        Returns a new S instance telling ElasticSearch whether to cache the
+        combination of all its filters, and optionally the `key` to cache it
+        under.  Use :meth:`F.filter_cache` to control single filters.
+        """
+        return self._clone(next_step=('filter_cache', (cache, key)))
+
+    def post_filter(self, post=True):
+        """
+        Returns a new S instance whose filters are applied to the hits after
+        the query ran, the way ElasticSearch's top level ``filter`` works,
+        instead of being compiled into a ``filtered`` query.  Facets then
+        ignore the filters unless they get them as their ``facet_filter``,
+        which is done for every facet that doesn't set its own.  Slower, but
+        it keeps drill-down facets counting over the whole query.
+        """
+        return self._clone(next_step=('post_filter', post))
 
     def facet(self, **kw):
         """
         Returns a new S instance with the facet args combined to the existing
         set.
         """
-        return self._clone(next_step=('facet', kw.items()))
+        return self._clone(next_step=('facet', tuple(kw.items())))
 
     def extra(self, **kw):
         """
@@ -237,24 +578,96 @@ class S(object):
         set.
         """
         new = self._clone()
+        if kw:
+            new._shared = weakref.WeakSet()
         actions = 'values values_dict order_by query filter facet'.split()
         for key, vals in kw.items():
             assert key in actions
             if hasattr(vals, 'items'):
-                new.steps.append((key, vals.items()))
+                new.steps += ((key, tuple(vals.items())),)
             else:
-                new.steps.append((key, vals))
+                new.steps += ((key, tuple(vals)),)
+        return new
+
+    def cache(self, timeout=None):
+        """
+        Returns a new S instance whose raw results are cached across
+        requests for `timeout` seconds (``ES_RESULT_CACHE_TIMEOUT``, 60 by
+        default), so identical searches don't go to ElasticSearch each time.
+        """
+        new = self._clone()
+        if timeout is None:
+            timeout = getattr(settings, 'ES_RESULT_CACHE_TIMEOUT', 60)
+        new._cache_timeout = timeout
+        return new
+
+    def timeout(self, seconds):
+        """
+        Returns a new S instance whose search may take at most `seconds`,
+        retries included.
+        """
+        new = self._clone()
+        new._timeout = seconds
         return new
 
+    def filter_path(self, *paths):
+        """
+        Returns a new S instance asking ElasticSearch to leave everything
+        out of its response but `paths`, like ``'hits.hits._score'``, and
+        what the results are built from.  Shard statistics, scores, index
+        and type names of the hits are dropped unless asked for.
+
+        Needs ElasticSearch 1.6; older versions ignore it.  Searches run by
+        :func:`execute_many` aren't trimmed.
+        """
+        new = self._clone()
+        new._filter_path = _NEEDED_PATHS + paths
+        return new
+
+    def _search_params(self):
+        """Returns the URL parameters of the search."""
+        if self._filter_path:
+            return {'filter_path': ','.join(self._filter_path)}
+        return {}
+
     def count(self):
         """
         Returns the number of hits for the current query and filters as an
         integer.
+
+        If this S or another slice of it whose results are still in use has
+        already been searched, the total from that search is returned without
+        asking ElasticSearch.
         """
-        if self._results_cache:
-            return self._results_cache.count
-        else:
-            return self[:0].raw()['hits']['total']
+        results = self._shared_results()
+        if results is not None:
+            return results.count
+        return self[:0].raw()['hits']['total']
+
+    def _shared_results(self):
+        """
+        Returns the results of this S, or of a slice of it that are still in
+        use, or None if there are none.
+        """
+        if self._results_cache is not None:
+            return self._results_cache
+        elif self._facets_cache is not None:
+            return self._facets_cache
+        for results in list(self._shared):
+            return results
+
+    def paginate(self, page=1, per_page=20):
+        """
+        Returns a :class:`Page` with the results of page number `page`
+        (starting at 1) and the total number of hits, fetched with a single
+        search.  Raises ValueError if `page` or `per_page` is less than 1.
+        """
+        if page < 1 or per_page < 1:
+            raise ValueError('Invalid page %r with %r results per page.' %
+                             (page, per_page))
+        start = (page - 1) * per_page
+        results = self[start:start + per_page]._do_search()
+        return Page(list(results), page, per_page, results.count)
 
     def __len__(self):
         return len(self._do_search())
@@ -271,16 +684,118 @@ class S(object):
 
     def _build_query(self):
         """
-        Loops self.steps to build the query format that will be sent to
+        Compiles self.steps into the query format that will be sent to
         ElasticSearch, and returns it as a dict.
+
+        The result is memoized, so it must not be modified.
         """
-        filters = []
-        queries = []
-        sort = []
-        fields = ['id']
-        facets = {}
-        as_list = as_dict = False
-        for action, value in self.steps:
+        if self._query is not None and self._query[0] == (self.start,
+                                                           self.stop):
+            return self._query[1]
+        start = time.time()
+        state = self._compile()
+        filters, queries = state['filters'], state['queries']
+        fields = list(state['fields'])
+
+        qs = {}
+        filter_ = query = None
+        if len(filters) > 1:
+            filter_ = {'and': list(filters)}
+        elif filters:
+            filter_ = filters[0]
+        if filter_ and state['filter_cache']:
+            filter_ = _cache_filter(filter_, *state['filter_cache'])
+
+        if len(queries) > 1:
+            query = {'bool': {'must': list(queries)}}
+        elif queries:
+            query = queries[0]
+
+        # Filtering the query, rather than filtering hits afterwards, lets
+        # ElasticSearch skip documents early and restricts facets too.
+        post_filter = filter_ and state['post_filter']
+        if post_filter:
+            qs['filter'] = filter_
+            if query:
+                qs['query'] = query
+        elif filter_:
+            qs['query'] = {'filtered': {'query': query or {'match_all': {}},
+                                        'filter': filter_}}
+        elif query:
+            qs['query'] = query
+
+        hydrate = state['hydrate']
+        from_source = (hydrate.get('source') and not state['as_list'] and
+                       not state['as_dict'])
+        # Without hits there is nothing to fetch, sort or skip.
+        no_hits = self.stop is not None and self.stop <= self.start
+        if (state['as_list'] or state['as_dict']) and fields and not no_hits:
+            qs['fields'] = fields
+        elif not (state['as_list'] or state['as_dict'] or from_source or
+                  no_hits):
+            # Objects are looked up by _id, so no field has to be loaded.
+            qs['fields'] = []
+        if state['source'] and not no_hits:
+            include, exclude = state['source']
+            qs['_source'] = source = {}
+            if include:
+                source['include'] = list(include)
+            if exclude:
+                source['exclude'] = list(exclude)
+        if state['facets']:
+            # Global facets ignore the query, so they get the filters as
+            # their facet_filter.  You probably wanted this.
+            qs['facets'] = facets = {}
+            for name, facet in state['facets'].items():
+                if ((post_filter or facet.get('global')) and filter_ and
+                    'facet_filter' not in facet):
+                    facet = dict(facet, facet_filter=filter_)
+                facets[name] = facet
+        if state['sort'] and not no_hits:
+            qs['sort'] = list(state['sort'])
+        if self.start and not no_hits:
+            qs['from'] = self.start
+        if self.stop is not None:
+            qs['size'] = self.stop - self.start
+
+        self.fields, self.as_list, self.as_dict = (fields, state['as_list'],
+                                                   state['as_dict'])
+        self.hydration = hydrate
+        self._query = (self.start, self.stop), qs
+        instrumentation.emit('build', doc_type=self.type._meta.db_table,
+                             elapsed=time.time() - start)
+        return qs
+
+    def _compile(self):
+        """
+        Returns the compiled state of self.steps as a dict.
+
+        Compiling extends the state of the S this one was cloned from, so
+        only the steps added since are processed.  States are shared between
+        clones and never modified.
+        """
+        if self._compiled is None:
+            # Walk up to the closest compiled ancestor without recursing, so
+            # long chains don't hit the recursion limit.
+            pending = []
+            s = self
+            while s._compiled is None and s._base is not None:
+                pending.append(s)
+                s = s._base
+            if s._compiled is None:
+                s._compiled = self._apply_steps(_EMPTY_STATE, s.steps)
+            state, done = s._compiled, len(s.steps)
+            for s in reversed(pending):
+                state = self._apply_steps(state, s.steps[done:])
+                s._compiled, s._base, done = state, None, len(s.steps)
+        return self._compiled
+
+    def _apply_steps(self, state, steps):
+        """Returns a new state with `steps` applied to `state`."""
+        if not steps:
+            return state
+        state = dict(state)
+        for action, value in steps:
             if action == 'order_by':
                 sort = []
                 for key in value:
@@ -288,52 +803,34 @@ class S(object):
                         sort.append({key[1:]: 'desc'})
                     else:
                         sort.append(key)
+                state['sort'] = tuple(sort)
             elif action == 'values':
-                fields.extend(value)
-                as_list, as_dict = True, False
+                state['fields'] += tuple(value)
+                state['as_list'], state['as_dict'] = True, False
             elif action == 'values_dict':
                 if not value:
-                    fields = []
+                    state['fields'] = ()
                 else:
-                    fields.extend(value)
-                as_list, as_dict = False, True
+                    state['fields'] += tuple(value)
+                state['as_list'], state['as_dict'] = False, True
             elif action == 'query':
-                queries.extend(self._process_queries(value))
+                state['queries'] += tuple(self._process_queries(value))
             elif action == 'filter':
-                filters.extend(_process_filters(value))
+                state['filters'] += tuple(_process_filters(value))
             elif action == 'facet':
-                facets.update(value)
+                state['facets'] = dict(state['facets'])
+                state['facets'].update(value)
+            elif action == 'hydrate':
+                state['hydrate'] = dict(value)
+            elif action == 'filter_cache':
+                state['filter_cache'] = value
+            elif action == 'post_filter':
+                state['post_filter'] = value
+            elif action == 'source':
+                state['source'] = value
             else:
                 raise NotImplementedError(action)
-
-        qs = {}
-        if len(filters) > 1:
-            qs['filter'] = {'and': filters}
-        elif filters:
-            qs['filter'] = filters[0]
-
-        if len(queries) > 1:
-            qs['query'] = {'bool': {'must': queries}}
-        elif queries:
-            qs['query'] = queries[0]
-
-        if fields:
-            qs['fields'] = fields
-        if facets:
-            qs['facets'] = facets
-            # Copy filters into facets. You probably wanted this.
-            for facet in facets.values():
-                if 'facet_filter' not in facet and filters:
-                    facet['facet_filter'] = qs['filter']
-        if sort:
-            qs['sort'] = sort
-        if self.start:
-            qs['from'] = self.start
-        if self.stop is not None:
-            qs['size'] = self.stop - self.start
-
-        self.fields, self.as_list, self.as_dict = fields, as_list, as_dict
-        return qs
+        return state
 
     def _process_queries(self, value):
         rv = []
@@ -360,94 +857,459 @@ class S(object):
         Performs the search, then converts that raw format into a
         SearchResults instance and returns it.
         """
-        if not self._results_cache:
-            hits = self.raw()
-            if self.as_dict:
-                ResultClass = DictSearchResults
-            elif self.as_list:
-                ResultClass = ListSearchResults
-            else:
-                ResultClass = ObjectSearchResults
-            self._results_cache = ResultClass(self.type, hits, self.fields)
+        if self._results_cache is None:
+            self._set_results(self.raw())
         return self._results_cache
 
+    def _set_results(self, hits):
+        """Converts the raw response `hits` into the results cache."""
+        self._results_cache = self._results_class()(
+            self.type, hits, self.fields, self.hydration)
+        self._shared.add(self._results_cache)
+
+    def _results_class(self):
+        if self.as_dict:
+            return DictSearchResults
+        elif self.as_list:
+            return ListSearchResults
+        else:
+            return ObjectSearchResults
+
+    def iterator(self, chunk_size=500, scroll='5m'):
+        """
+        Returns a generator over every result, fetched with ElasticSearch's
+        scan and scroll API `chunk_size` hits per shard at a time.  Memory
+        use stays bounded however many results there are.
+
+        `scroll` is how long ElasticSearch keeps the scroll open between
+        chunks.  Scanning doesn't sort, and slicing is ignored.  Model
+        instances aren't shared through the identity map, which would keep
+        all of them.
+        """
+        qs = dict(self._build_query())
+        for key in ('from', 'size', 'sort'):
+            qs.pop(key, None)
+        qs['size'] = chunk_size
+        doc_type = self.type._meta.db_table
+        es = get_es()
+        response = es.search(qs, get_index(doc_type), doc_type,
+                             search_type='scan', scroll=scroll)
+        ResultClass = self._results_class()
+        while True:
+            response = es._send_request('GET', '/_search/scroll',
+                                        response['_scroll_id'],
+                                        {'scroll': scroll})
+            if not response['hits']['hits']:
+                return
+            results = ResultClass(self.type, response, self.fields,
+                                  self.hydration)
+            results.use_identity_map = False
+            for result in results:
+                yield result
+
+    def execute_async(self):
+        """
+        Starts the search in a background thread and returns an object whose
+        ``get(timeout=None)`` method waits for and returns the results.
+
+        Afterwards the results are cached on this S like for a normal
+        search, so several searches can be waited on concurrently::
+
+            pending = [s.execute_async() for s in (s1, s2, s3)]
+            results = [p.get() for p in pending]
+        """
+        return get_pool().apply_async(self._do_search)
+
     def raw(self):
         """
         Builds query and passes to ElasticSearch, then returns the raw format
         returned.
+
+        If another thread is already running the same search, this waits for
+        its response instead of sending the search again (see
+        :mod:`elasticutils.singleflight`).
         """
+        start = time.time()
         qs = self._build_query()
-        es = get_es()
-        index = (settings.ES_INDEXES.get(self.type)
-                 or settings.ES_INDEXES['default'])
-        try:
-            hits = es.search(qs, index, self.type._meta.db_table)
-        except Exception:
-            log.error(qs)
-            raise
-        if statsd:
-            statsd.timing('search', hits['took'])
-        log.debug('[%s] %s' % (hits['took'], qs))
+        doc_type = self.type._meta.db_table
+        index = get_index(doc_type)
+        params = self._search_params()
+        hits = self._cached_response(qs, index, doc_type, params)
+        cached, coalesced = hits is not None, False
+        if not cached:
+            es = get_es()
+
+            def search():
+                hits = self._request(
+                    lambda: es.search(qs, index, doc_type, **params))
+                # filter_path leaves out the list of hits if it's empty.
+                hits['hits'].setdefault('hits', [])
+                return hits
+
+            flight = get_single_flight()
+            try:
+                with instrumentation.context(doc_type=doc_type, index=index):
+                    if flight is None:
+                        hits = search()
+                    else:
+                        hits, coalesced = flight.do(
+                            cache_key(qs, index, doc_type, params), search,
+                            self._timeout)
+            except Exception:
+                log.error(qs)
+                raise
+            # A coalesced response was cached by the thread that sent it.
+            if not coalesced:
+                self._got_response(hits, qs, index, doc_type, params)
+        self._searched(hits, qs, index, doc_type, start, cached,
+                       coalesced=coalesced)
         return hits
 
+    def _request(self, f):
+        """
+        Calls `f`, retrying transient errors, within this S's time budget.
+        Only use it for requests that are safe to repeat.
+        """
+        if self._timeout is None:
+            return with_retries(f)
+        with deadline(self._timeout):
+            return with_retries(f)
+
+    def _cached_response(self, qs, index, doc_type, params=None):
+        """Returns the response for `qs` from the result cache, if any."""
+        if self._cache_timeout:
+            hits = get_result_cache().get(
+                cache_key(qs, index, doc_type, params))
+            if hits is not None:
+                return hits
+
+    def _got_response(self, hits, qs, index, doc_type, params=None):
+        """Records a response that came from ElasticSearch."""
+        log.debug('[%s] %s' % (hits['took'], qs))
+        if self._cache_timeout:
+            get_result_cache().set(cache_key(qs, index, doc_type, params),
+                                   hits, self._cache_timeout)
+
+    def _searched(self, hits, qs, index, doc_type, start, cached,
+                  origin=None, coalesced=False):
+        """Emits the ``search`` instrumentation event."""
+        if instrumentation.enabled('search'):
+            instrumentation.emit(
+                'search', doc_type=doc_type, index=index, query=qs,
+                took=hits['took'], elapsed=time.time() - start,
+                hits=hits['hits']['total'], cached=cached,
+                coalesced=coalesced,
+                origin=origin or instrumentation.origin())
+
     def __iter__(self):
         return iter(self._do_search())
 
     def raw_facets(self):
-        return self._do_search().results.get('facets', {})
+        """
+        Returns the facets section of the response.
+
+        If the results haven't been fetched, only the facets are: the search
+        asks for no hits, so nothing is fetched or loaded from the database.
+        Like results, they're kept by this S and reused by its slices while
+        it's in use.
+        """
+        results = self._shared_results()
+        if results is None:
+            results = self._facets_cache = self[:0]._do_search()
+        return results.results.get('facets', {})
 
     @property
     def facets(self):
+        """
+        The facets parsed by their type, see :data:`FACET_PARSERS`.  Facets
+        of other types are left as ElasticSearch returned them.
+        """
         facets = {}
         for key, val in self.raw_facets().items():
-            if val['_type'] == 'terms':
-                facets[key] = [v for v in val['terms']]
-            elif val['_type'] == 'range':
-                facets[key] = [v for v in val['ranges']]
+            parse = FACET_PARSERS.get(val.get('_type'))
+            facets[key] = parse(val) if parse else val
         return facets
 
 
+def _facet_stats(facet):
+    return dict((k, v) for k, v in facet.items() if k != '_type')
+
+
+#: How :attr:`S.facets` turns each type of facet into something useful.
+FACET_PARSERS = {
+    # Lists of {'term': ..., 'count': ...}, and totals for terms_stats.
+    'terms': lambda facet: facet['terms'],
+    'terms_stats': lambda facet: facet['terms'],
+    # Lists of {'from': ..., 'to': ..., 'count': ...} and statistics.
+    'range': lambda facet: facet['ranges'],
+    'geo_distance': lambda facet: facet['ranges'],
+    # Lists of {'key': ..., 'count': ...}; 'time' instead of 'key' for dates.
+    'histogram': lambda facet: facet['entries'],
+    'date_histogram': lambda facet: facet['entries'],
+    # Dicts of count, total, min, max, mean, variance, std_deviation...
+    'statistical': _facet_stats,
+    # The number of documents matching.
+    'query': lambda facet: facet['count'],
+    'filter': lambda facet: facet['count'],
+}
+
+
+def execute_many(searches):
+    """
+    Runs every S in `searches` that hasn't been evaluated yet with a single
+    ``_msearch`` request, so iterating over them afterwards doesn't go back
+    to ElasticSearch.  Returns `searches`.
+
+    If some of the searches fail, the others still get their results and an
+    ElasticSearchException is raised for the first failure.
+    """
+    start = time.time()
+    origin = instrumentation.enabled('search') and instrumentation.origin()
+    batch = []
+    for s in searches:
+        if s._results_cache is not None:
+            continue
+        qs = s._build_query()
+        doc_type = s.type._meta.db_table
+        index = get_index(doc_type)
+        hits = s._cached_response(qs, index, doc_type)
+        if hits is None:
+            batch.append((s, qs, index, doc_type))
+        else:
+            s._searched(hits, qs, index, doc_type, start, True, origin)
+            s._set_results(hits)
+    if not batch:
+        return searches
+
+    es = get_es()
+    serializer = get_serializer()
+    lines = []
+    for s, qs, index, doc_type in batch:
+        lines.append(serializer.dumps({'index': index, 'type': doc_type}) +
+                     '\n')
+        lines.append(serializer.dumps(qs) + '\n')
+    try:
+        body = stream_body(es, lines)
+        response = with_retries(
+            lambda: es._send_request('GET', '/_msearch', body))
+    except Exception:
+        log.error([qs for s, qs, index, doc_type in batch])
+        raise
+
+    error = None
+    for (s, qs, index, doc_type), hits in zip(batch, response['responses']):
+        if 'error' in hits:
+            log.error('%s: %s' % (hits['error'], qs))
+            error = error or exceptions.ElasticSearchException(hits['error'])
+            continue
+        s._got_response(hits, qs, index, doc_type)
+        s._searched(hits, qs, index, doc_type, start, False, origin)
+        s._set_results(hits)
+    if error:
+        raise error
+    return searches
+
+
+def execute_concurrently(searches, timeout=None):
+    """
+    Runs every S in `searches` at the same time in the background thread
+    pool, waits for all of them (at most `timeout` seconds each) and returns
+    `searches`.  Unlike :func:`execute_many` the searches are independent
+    requests; if any of them fails, the first error is raised once all of
+    them are done.
+    """
+    pending = [s.execute_async() for s in searches
+               if s._results_cache is None]
+    error = None
+    for result in pending:
+        try:
+            result.get(timeout)
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+    return searches
+
+
+class Page(object):
+    """A page of results returned by :meth:`S.paginate`."""
+
+    def __init__(self, object_list, number, per_page, count):
+        self.object_list = object_list
+        self.number = number
+        self.per_page = per_page
+        self.count = count
+
+    @property
+    def num_pages(self):
+        return max(1, (self.count + self.per_page - 1) // self.per_page)
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def has_previous(self):
+        return self.number > 1
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
 class SearchResults(object):
-    def __init__(self, type, results, fields):
+    """
+    The results of a search.  Hits are converted by `convert` when they're
+    iterated over or indexed, so no second copy of every result is built.
+    Using `objects` converts all of them into a list and drops the raw hits.
+
+    `results` is the raw response without its hits.
+    """
+
+    def __init__(self, type, results, fields, hydration=None):
         self.type = type
         self.took = results['took']
         self.count = results['hits']['total']
-        self.results = results
+        # Copied rather than emptied: the response may be in the cache.
+        self.results = dict(results, hits=dict(results['hits'], hits=[]))
         self.fields = fields
-        self.set_objects(results['hits']['hits'])
+        self.hydration = hydration or {}
+        self._hits = results['hits']['hits']
+        self._objects = None
+        self.set_objects(self._hits)
 
     def set_objects(self, hits):
+        """Prepares the conversion of `hits`."""
+
+    def convert(self, hit):
+        """Returns the result for the raw `hit`."""
         raise NotImplementedError()
 
+    @property
+    def objects(self):
+        if self._objects is None:
+            self._objects = [self.convert(hit) for hit in self._hits]
+            self._hits = None
+        return self._objects
+
     def __iter__(self):
-        return iter(self.objects)
+        if self._objects is not None:
+            return iter(self._objects)
+        return (self.convert(hit) for hit in self._hits)
+
+    def __getitem__(self, k):
+        if self._objects is not None:
+            return self._objects[k]
+        elif isinstance(k, slice):
+            return [self.convert(hit) for hit in self._hits[k]]
+        return self.convert(self._hits[k])
 
     def __len__(self):
-        return len(self.objects)
+        if self._objects is not None:
+            return len(self._objects)
+        return len(self._hits)
 
 
 class DictSearchResults(SearchResults):
     def set_objects(self, hits):
-        key = 'fields' if self.fields else '_source'
-        self.objects = [r[key] for r in hits]
+        self._key = 'fields' if self.fields else '_source'
+
+    def convert(self, hit):
+        return hit[self._key]
 
 
 class ListSearchResults(SearchResults):
+    """Results as tuples of the requested fields."""
+
     def set_objects(self, hits):
-        if self.fields:
-            getter = itemgetter(*self.fields)
-            objs = [getter(r['fields']) for r in hits]
-        else:
-            objs = [r['_source'].values() for r in hits]
-        self.objects = objs
+        self._getter = itemgetter(*self.fields) if self.fields else None
+
+    def convert(self, hit):
+        if self._getter is None:
+            return tuple(hit['_source'].values())
+        return self._getter(hit['fields'])
 
 
 class ObjectSearchResults(SearchResults):
+    """
+    Model instances for the hits, in the order of the hits.  They are loaded
+    the first time they're needed and then kept, so iterating again doesn't
+    go back to the database.  Instances already loaded by another search in
+    the same identity map (see :mod:`elasticutils.identity`) are reused,
+    unless `use_identity_map` is False.
+    """
+    use_identity_map = True
+
     def set_objects(self, hits):
         self.ids = [int(r['_id']) for r in hits]
-        self.objects = self.type.objects.filter(id__in=self.ids)
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            start = time.time()
+            if self.hydration.get('source'):
+                objs = self._from_source()
+            else:
+                objs = self._from_db()
+            self._objects = [objs[id] for id in self.ids if id in objs]
+            self._hits = None
+            instrumentation.emit(
+                'hydrate', doc_type=self.type._meta.db_table,
+                objects=len(self._objects),
+                source=bool(self.hydration.get('source')),
+                elapsed=time.time() - start)
+        return self._objects
 
     def __iter__(self):
-        objs = dict((obj.id, obj) for obj in self.objects)
-        return (objs[id] for id in self.ids if id in objs)
+        return iter(self.objects)
+
+    def __getitem__(self, k):
+        return self.objects[k]
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _identity_map(self):
+        return get_identity_map() if self.use_identity_map else None
+
+    def _from_db(self):
+        identity_map = self._identity_map()
+        # Instances loaded with select_related or only are only shared with
+        # searches loading them the same way, so nobody gets deferred fields
+        # they didn't ask for.
+        key = self.type
+        if self.hydration.get('select_related') or self.hydration.get('only'):
+            key = (self.type, self.hydration.get('select_related'),
+                   self.hydration.get('only'))
+        objs = identity_map.get_many(key, self.ids) if identity_map else {}
+        missing = [id for id in self.ids if id not in objs]
+        if missing:
+            fetched = list(self._queryset(missing))
+            objs.update((obj.id, obj) for obj in fetched)
+            if identity_map is not None:
+                identity_map.add(key, fetched)
+        return objs
+
+    def _queryset(self, ids):
+        qs = self.type.objects.filter(id__in=ids)
+        select_related = self.hydration.get('select_related')
+        if select_related is True:
+            qs = qs.select_related()
+        elif select_related:
+            qs = qs.select_related(*select_related)
+        if self.hydration.get('only'):
+            qs = qs.only(*self.hydration['only'])
+        return qs
+
+    def _from_source(self):
+        identity_map = self._identity_map()
+        objs = identity_map.get_many(self.type, self.ids) if identity_map else {}
+        build = getattr(self.type, 'from_source', None) or (
+            lambda source: self.type(**source))
+        for id, hit in zip(self.ids, self._hits):
+            if id not in objs:
+                source = dict(hit.get('_source') or {})
+                source.setdefault('id', id)
+                objs[id] = build(source)
+        return objs
 
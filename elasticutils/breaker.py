@@ -0,0 +1,232 @@
+"""
+Protection against a degraded cluster: time budgets for requests, a circuit
+breaker that fails requests fast once too many of them fail, and retries
+with jitter for requests that are safe to repeat.
+"""
+import errno
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from pyes.exceptions import ElasticSearchException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+try:
+    from statsd import statsd
+except ImportError:
+    statsd = None
+
+
+log = logging.getLogger('elasticsearch')
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+_local = threading.local()
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Limits the requests sent through the connection pool inside the block
+    to `seconds` in total, including retries.  Nested deadlines can only
+    shorten it.
+    """
+    old = getattr(_local, 'deadline', None)
+    new = time.time() + seconds
+    _local.deadline = new if old is None else min(old, new)
+    try:
+        yield
+    finally:
+        _local.deadline = old
+
+
+def remaining():
+    """Returns the seconds left before the current deadline, or None."""
+    if getattr(_local, 'deadline', None) is not None:
+        return _local.deadline - time.time()
+
+
+class BudgetExceeded(socket.timeout):
+    """The time allowed by `deadline` ran out."""
+
+
+class ConnectError(socket.error):
+    """A node could not be connected to."""
+
+
+class CircuitOpen(ElasticSearchException):
+    """Raised instead of sending a request while the circuit is open."""
+
+
+class ConnectionFailed(ElasticSearchException):
+    """
+    A request to a node failed without an answer; `error` is the
+    ``socket.error`` or ``httplib.HTTPException`` behind it.
+    """
+
+    def __init__(self, error):
+        ElasticSearchException.__init__(self, error)
+        self.error = error
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of requests over the last `window` seconds.
+
+    Once at least `min_calls` requests were made and the share of failures
+    reaches `threshold`, the circuit opens: requests fail immediately with
+    :class:`CircuitOpen` for `reset_timeout` seconds.  Then a single trial
+    request is let through (half open); the circuit closes if it succeeds
+    and opens again if it fails.
+    """
+
+    def __init__(self, threshold=None, min_calls=None, window=None,
+                 reset_timeout=None):
+        self.threshold = threshold or getattr(
+            settings, 'ES_BREAKER_THRESHOLD', 0.5)
+        self.min_calls = min_calls or getattr(
+            settings, 'ES_BREAKER_MIN_CALLS', 20)
+        self.window = window or getattr(settings, 'ES_BREAKER_WINDOW', 30)
+        self.reset_timeout = reset_timeout or getattr(
+            settings, 'ES_BREAKER_RESET_TIMEOUT', 10)
+        self.state = CLOSED
+        self.opened_at = 0
+        # [second, calls, failures] for each second in the window.
+        self._buckets = deque()
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Raises CircuitOpen if a request may not be sent now."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpen('Circuit open, not sending requests.')
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    raise CircuitOpen('Circuit half open, waiting on a '
+                                      'trial request.')
+                self._trial = True
+
+    def cancel(self):
+        """
+        Records that the request let through by `before` wasn't sent after
+        all, e.g. because no connection was free, which says nothing about
+        the cluster.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial = False
+
+    def success(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial = False
+                self._buckets.clear()
+                self._set_state(CLOSED)
+            else:
+                self._record(False)
+
+    def failure(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial = False
+                self._open()
+                return
+            self._record(True)
+            calls, failures = self._counts()
+            if (self.state == CLOSED and calls >= self.min_calls and
+                failures >= self.threshold * calls):
+                self._open()
+
+    def stats(self):
+        with self._lock:
+            calls, failures = self._counts()
+        return {'state': self.state, 'calls': calls, 'failures': failures,
+                'error_rate': float(failures) / calls if calls else 0.0}
+
+    def _record(self, failed):
+        second = int(time.time())
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0])
+        self._buckets[-1][1] += 1
+        self._buckets[-1][2] += int(failed)
+
+    def _counts(self):
+        oldest = time.time() - self.window
+        while self._buckets and self._buckets[0][0] < oldest:
+            self._buckets.popleft()
+        return (sum(b[1] for b in self._buckets),
+                sum(b[2] for b in self._buckets))
+
+    def _open(self):
+        self.opened_at = time.time()
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        log.warning('ElasticSearch circuit breaker is %s.' % state)
+        self.state = state
+        if statsd:
+            statsd.incr('search.breaker.%s' % state)
+
+
+# Errors of sockets that show the node never got the request: it couldn't
+# be connected to, or it had closed the connection.
+RESEND_ERRNOS = (errno.ECONNREFUSED, errno.ECONNRESET, errno.ECONNABORTED,
+                 errno.EPIPE)
+
+
+def is_transient(error):
+    """
+    Returns whether `error` shows that a request never reached a node, so
+    sending it again can't add to the node's load.  Timeouts aren't: the
+    node may still be working on the request.
+    """
+    if isinstance(error, ConnectionFailed):
+        error = error.error
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, socket.error):
+        return (isinstance(error, ConnectError) or
+                getattr(error, 'errno', None) in RESEND_ERRNOS)
+    return isinstance(error, httplib.BadStatusLine)
+
+
+def with_retries(f, retries=None, delay=None):
+    """
+    Calls `f` and returns its result, calling it again up to `retries` times
+    (``ES_RETRIES``, 2 by default) if it fails with an error that
+    :func:`is_transient`.  Timeouts are never retried.
+
+    Before retry number ``n`` it sleeps a random time up to
+    ``delay * 2 ** n`` seconds (``ES_RETRY_DELAY``, 0.05 by default), so
+    clients don't retry in lockstep.  It gives up early when that would
+    overrun the current :func:`deadline`.  Only use this for requests that
+    are safe to repeat.
+    """
+    retries = getattr(settings, 'ES_RETRIES', 2) if retries is None else retries
+    delay = delay or getattr(settings, 'ES_RETRY_DELAY', 0.05)
+    for attempt in range(retries + 1):
+        try:
+            return f()
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            pause = random.uniform(0, delay * 2 ** attempt)
+            left = remaining()
+            if attempt == retries or (left is not None and left <= pause):
+                raise
+            log.warning('Retrying after %r.' % e)
+            if statsd:
+                statsd.incr('search.retry')
+            time.sleep(pause)
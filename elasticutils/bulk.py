@@ -0,0 +1,318 @@
+"""
+Helpers for pushing large numbers of documents into ElasticSearch through
+the ``_bulk`` API.
+"""
+import logging
+import threading
+import time
+from Queue import Queue
+
+from pyes import exceptions
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+import elasticutils
+from elasticutils import instrumentation
+from elasticutils.serializers import get_serializer
+
+
+log = logging.getLogger('elasticutils')
+
+
+class RebuildFailed(Exception):
+    """
+    Loading a rebuilt index failed; `errors` holds the ``(id, error)``
+    tuples of the actions that failed.
+    """
+
+    def __init__(self, message, errors=()):
+        Exception.__init__(self, message)
+        self.errors = list(errors)
+
+
+def iter_keyset(queryset, chunk_size, key=lambda obj: obj.pk):
+    """
+    Yields lists of at most `chunk_size` objects from `queryset`.
+
+    Rows are read in primary key order and each chunk starts after the last
+    key of the previous one, so every query is a cheap range scan instead of
+    an ever growing ``OFFSET``.  `key` returns the primary key of a row, e.g.
+    ``lambda pk: pk`` for ``values_list('pk', flat=True)``.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        qs = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = key(chunk[-1])
+
+
+class BulkIndexer(object):
+    """
+    Buffers index and delete actions and sends them to ElasticSearch with
+    ``_bulk`` requests.
+
+    A request is sent as soon as the buffer holds `max_docs` actions or
+    `max_bytes` bytes of payload.  With `concurrency` greater than one the
+    requests are sent from that many worker threads, so serialization and
+    network round trips overlap; at most `concurrency` batches wait in the
+    queue at a time.
+
+    Call :meth:`close` when done to send whatever is left and wait for the
+    workers.  Failed actions are collected in `errors` as ``(id, error)``
+    tuples; if a whole request fails, every action in it is, and indexing
+    goes on with the next batch.
+    """
+
+    def __init__(self, es=None, max_docs=None, max_bytes=None,
+                 concurrency=1):
+        self.es = es or elasticutils.get_es()
+        self.max_docs = max_docs or getattr(settings, 'ES_BULK_DOCS', 500)
+        self.max_bytes = max_bytes or getattr(settings, 'ES_BULK_BYTES',
+                                              5 * 1024 * 1024)
+        self.concurrency = concurrency
+        self.docs = self.batches = self.bytes = 0
+        self.errors = []
+        self.started = time.time()
+        # Worker threads tag their events like the thread creating us.
+        self._tags = instrumentation.current_tags()
+
+        self._lines = []
+        self._ids = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._workers = []
+        if concurrency > 1:
+            self._queue = Queue(maxsize=concurrency)
+            for i in range(concurrency):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def index(self, index, doc_type, id, document):
+        """Queues `document` to be indexed under `id`."""
+        action = {'index': {'_index': index, '_type': doc_type, '_id': id}}
+        self._add(id, action, document)
+
+    def delete(self, index, doc_type, id):
+        """Queues the document `id` to be removed from the index."""
+        action = {'delete': {'_index': index, '_type': doc_type, '_id': id}}
+        self._add(id, action)
+
+    def _add(self, id, action, document=None):
+        serializer = get_serializer()
+        lines = [serializer.dumps(action) + '\n']
+        if document is not None:
+            lines.append(serializer.dumps(document) + '\n')
+        size = sum(len(line) for line in lines)
+        if self._ids and (len(self._ids) >= self.max_docs or
+                          self._size + size > self.max_bytes):
+            self.flush()
+        self._lines.extend(lines)
+        self._ids.append(id)
+        self._size += size
+
+    def flush(self):
+        """Sends the buffered actions."""
+        if not self._ids:
+            return
+        # The lines are streamed to ElasticSearch rather than joined into
+        # another copy of the whole body.
+        batch = (elasticutils.stream_body(self.es, self._lines), self._ids,
+                 self._size)
+        self._lines, self._ids, self._size = [], [], 0
+        if self._workers:
+            self._queue.put(batch)
+        else:
+            self._try_send(*batch)
+
+    def close(self):
+        """Sends the remaining actions and waits for pending requests."""
+        self.flush()
+        if self._workers:
+            for worker in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._workers = []
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            with instrumentation.context(**self._tags):
+                self._try_send(*batch)
+
+    def _try_send(self, body, ids, size):
+        """Sends a batch, recording all of its actions as failed on errors."""
+        try:
+            self._send(body, ids, size)
+        except Exception as error:
+            log.exception('Bulk request of %d actions failed.' % len(ids))
+            with self._lock:
+                self.errors.extend((id, str(error)) for id in ids)
+
+    def _send(self, body, ids, size):
+        start = time.time()
+        response = self.es._send_request('POST', '/_bulk', body)
+        errors = []
+        for item in response.get('items', []):
+            result = item.values()[0]
+            if 'error' in result:
+                errors.append((result.get('_id'), result['error']))
+                log.warning('Bulk action on [%s] failed: %s' %
+                            (result.get('_id'), result['error']))
+        with self._lock:
+            self.docs += len(ids) - len(errors)
+            self.batches += 1
+            self.bytes += size
+            self.errors.extend(errors)
+        instrumentation.emit('bulk', docs=len(ids), errors=len(errors),
+                             bytes=size, elapsed=time.time() - start)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def summary(self):
+        """Returns a one line report of the work done so far."""
+        elapsed = self.elapsed
+        return ('%d documents in %d batches (%.1f MB) in %.1fs, '
+                '%.1f docs/s, %d errors.' %
+                (self.docs, self.batches, self.bytes / 1048576.0, elapsed,
+                 self.docs / elapsed if elapsed else 0, len(self.errors)))
+
+
+def reindex(model, queryset=None, index=None, chunk_size=None,
+            max_docs=None, max_bytes=None, concurrency=1):
+    """
+    Streams every object in `queryset` (all objects of `model` by default)
+    into ElasticSearch and returns the :class:`BulkIndexer` that did the work.
+
+    The primary keys are read `chunk_size` at a time with keyset pagination
+    and each chunk is serialized with
+    :meth:`~elasticutils.models.SearchMixin.serialize_many`; `max_docs`,
+    `max_bytes` and `concurrency` are passed to :class:`BulkIndexer`.
+    """
+    if queryset is None:
+        queryset = model.objects.all()
+    index = index or model._get_index()
+    doc_type = model._meta.db_table
+    chunk_size = chunk_size or getattr(settings, 'ES_BULK_DOCS', 500)
+    with instrumentation.context(doc_type=doc_type, index=index):
+        indexer = BulkIndexer(max_docs=max_docs, max_bytes=max_bytes,
+                              concurrency=concurrency)
+        try:
+            pks = queryset.values_list('pk', flat=True)
+            for chunk in iter_keyset(pks, chunk_size, key=lambda pk: pk):
+                for id, document in model.serialize_many(
+                        queryset.filter(pk__in=chunk)):
+                    indexer.index(index, doc_type, id, document)
+        finally:
+            indexer.close()
+    return indexer
+
+
+def rebuild_index(alias, models, index_settings=None, delete_old=True,
+                  **kw):
+    """
+    Rebuilds the index behind `alias` without touching the live index.
+
+    A new index named after `alias` and the current time is created with
+    replicas and refreshing turned off, every object of `models` is bulk
+    loaded into it (`kw` is passed to :func:`reindex`), the settings from
+    `index_settings` are restored and `alias` is switched to the new index in
+    a single atomic ``_aliases`` call.  Searches and writes through the alias
+    keep hitting the old index until the switch, so changes made during the
+    rebuild have to be reindexed afterwards.
+
+    The number of replicas and the refresh interval not given in
+    `index_settings` are copied from the index currently behind `alias`.
+
+    If `alias` is currently the name of a real index, that index has to be
+    deleted before the alias can be created, so that first switch is not
+    atomic.
+
+    If loading the new index fails, even for a single action, the new index
+    is deleted and `alias` and the old index are left alone; failed actions
+    raise :class:`RebuildFailed`, other errors are raised as they are.
+
+    Returns the name of the new index.
+    """
+    es = elasticutils.get_es()
+    final = _live_settings(es, alias)
+    final.update(index_settings or {})
+    loading = dict(final, number_of_replicas=0, refresh_interval='-1')
+    new = '%s-%s' % (alias, time.strftime('%Y%m%d%H%M%S'))
+
+    log.info('Rebuilding %s into %s.' % (alias, new))
+    es.create_index(new, settings={'settings': loading})
+    loaded = False
+    try:
+        errors = []
+        for model in models:
+            if hasattr(model, 'get_mapping'):
+                es.put_mapping(model._meta.db_table, model.get_mapping(),
+                               [new])
+            indexer = reindex(model, index=new, **kw)
+            log.info('Loaded %s: %s' % (model._meta.db_table,
+                                        indexer.summary()))
+            errors.extend(indexer.errors)
+        if errors:
+            raise RebuildFailed('%d actions failed while loading %s.' %
+                                (len(errors), new), errors)
+
+        es._send_request('PUT', '/%s/_settings' % new, {
+            'index': {'number_of_replicas': final['number_of_replicas'],
+                      'refresh_interval': final['refresh_interval']}})
+        es._send_request('POST', '/%s/_refresh' % new)
+        loaded = True
+    finally:
+        if not loaded:
+            log.error('Rebuilding %s failed, deleting %s.' % (alias, new))
+            try:
+                es.delete_index(new)
+            except Exception:
+                log.exception('Could not delete %s.' % new)
+
+    try:
+        old = es.get_alias(alias)
+    except exceptions.IndexMissingException:
+        old = []
+    if alias in old:
+        log.warning('%s is an index, deleting it to create the alias.' %
+                    alias)
+        es.delete_index(alias)
+        old.remove(alias)
+    es.change_aliases([('remove', index, alias) for index in old] +
+                      [('add', new, alias)])
+    if delete_old:
+        for index in old:
+            es.delete_index(index)
+    return new
+
+
+def _live_settings(es, alias):
+    """
+    Returns the number of replicas and refresh interval of the newest index
+    behind `alias`, or ElasticSearch's defaults if there is none.
+    """
+    rv = {'number_of_replicas': 1, 'refresh_interval': '1s'}
+    try:
+        indexes = es._send_request('GET', '/%s/_settings' % alias)
+    except exceptions.IndexMissingException:
+        return rv
+    if indexes:
+        live = indexes[max(indexes)].get('settings', {})
+        for key in rv:
+            if 'index.%s' % key in live:
+                rv[key] = live['index.%s' % key]
+    return rv
@@ -0,0 +1,141 @@
+"""
+Caches for raw search responses, used by :meth:`elasticutils.S.cache`.
+"""
+import cPickle as pickle
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from pyes.es import ESJsonEncoder
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+try:
+    from statsd import statsd
+except ImportError:
+    statsd = None
+
+
+def cache_key(query, index, doc_type, params=None):
+    """
+    Returns a key for the compiled `query` against `index`/`doc_type`, with
+    the URL parameters `params`.
+    """
+    data = json.dumps([index, doc_type, query] + ([params] if params else []),
+                      sort_keys=True, cls=ESJsonEncoder)
+    return 'elasticutils:search:' + hashlib.md5(data).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Base class for result caches.  Subclasses implement `_get` and `_set`;
+    this class counts hits and misses.
+    """
+
+    def __init__(self):
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """Returns the cached response for `key`, or None."""
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+            if statsd:
+                statsd.incr('search.cache.miss')
+        else:
+            self.hits += 1
+            if statsd:
+                statsd.incr('search.cache.hit')
+        return value
+
+    def set(self, key, value, timeout):
+        """Caches `value` under `key` for `timeout` seconds."""
+        self._set(key, value, timeout)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _set(self, key, value, timeout):
+        raise NotImplementedError()
+
+
+class LRUCache(ResultCache):
+    """
+    An in-process cache holding at most `max_size` responses
+    (``ES_RESULT_CACHE_SIZE``, 1000 by default), evicting the least recently
+    used one first.
+
+    Responses are stored pickled, so every `get` returns a copy that callers
+    may modify without changing what later requests get.
+    """
+
+    def __init__(self, max_size=None):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size or getattr(settings, 'ES_RESULT_CACHE_SIZE',
+                                            1000)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self._data[key] = expires, value
+        return pickle.loads(value)
+
+    def _set(self, key, value, timeout):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = time.time() + timeout, value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        stats = super(LRUCache, self).stats()
+        stats['size'] = len(self._data)
+        return stats
+
+
+class DjangoCache(ResultCache):
+    """Stores responses in the default Django cache."""
+
+    def _get(self, key):
+        from django.core.cache import cache
+        return cache.get(key)
+
+    def _set(self, key, value, timeout):
+        from django.core.cache import cache
+        cache.set(key, value, timeout)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Returns the process wide instance of the ``ES_RESULT_CACHE`` class
+    (``elasticutils.cache.LRUCache`` by default).
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = getattr(settings, 'ES_RESULT_CACHE',
+                               'elasticutils.cache.LRUCache')
+                module, name = path.rsplit('.', 1)
+                _cache = getattr(__import__(module, {}, {}, [name]), name)()
+    return _cache
@@ -0,0 +1,137 @@
+"""
+Collects changes to searchable models and indexes them in batches.
+
+Instead of a task per saved object, :func:`track` connects signal handlers
+that put the ids of saved and deleted objects into a process wide
+:class:`ChangeBuffer`.  Repeated changes to one object are coalesced into
+one, and the buffer is flushed as a single task per model once it holds
+``ES_CHANGES_MAX_SIZE`` objects or its oldest change is
+``ES_CHANGES_MAX_AGE`` seconds old.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import signals
+
+
+log = logging.getLogger('elasticutils')
+
+INDEX, DELETE = 'index', 'delete'
+
+
+def send_to_tasks(model, index_ids, delete_ids, queued_at):
+    """Hands a batch of changes to :func:`elasticutils.tasks.apply_changes`."""
+    from elasticutils import tasks
+    tasks.apply_changes.delay(model, index_ids, delete_ids, queued_at)
+
+
+class ChangeBuffer(object):
+    """
+    Pending changes, keyed by model and id, so only the last change to an
+    object is applied: saving an object twice indexes it once, and deleting
+    it after saving only removes it.
+
+    `handler` is called on flush with ``(model, index_ids, delete_ids,
+    queued_at)`` for every model with changes, where `queued_at` is when the
+    oldest of them was made.  By default the batch is sent to a Celery task.
+    """
+
+    def __init__(self, max_size=None, max_age=None, handler=send_to_tasks):
+        self.max_size = max_size or getattr(settings, 'ES_CHANGES_MAX_SIZE',
+                                            100)
+        self.max_age = max_age or getattr(settings, 'ES_CHANGES_MAX_AGE', 1)
+        self.handler = handler
+        self.coalesced = self.flushed = 0
+        self._changes = {}
+        self._oldest = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, model, id, action=INDEX):
+        """Records that object `id` of `model` needs `action`."""
+        with self._lock:
+            if (model, id) in self._changes:
+                self.coalesced += 1
+            self._changes[model, id] = action
+            if self._oldest is None:
+                self._oldest = time.time()
+                # Flushes the buffer if nothing fills it in time.
+                self._timer = threading.Timer(self.max_age, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            full = len(self._changes) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Sends the pending changes to the handler."""
+        with self._lock:
+            changes, queued_at = self._changes, self._oldest
+            self._changes, self._oldest = {}, None
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        if not changes:
+            return
+        batches = {}
+        for (model, id), action in changes.items():
+            index_ids, delete_ids = batches.setdefault(model, ([], []))
+            (delete_ids if action == DELETE else index_ids).append(id)
+        for model, (index_ids, delete_ids) in batches.items():
+            try:
+                self.handler(model, sorted(index_ids), sorted(delete_ids),
+                             queued_at)
+            except Exception:
+                log.exception('Failed to send %d changes of %s.' %
+                              (len(index_ids) + len(delete_ids),
+                               model._meta.db_table))
+        self.flushed += len(changes)
+
+    def lag(self):
+        """Returns how many seconds the oldest pending change has waited."""
+        oldest = self._oldest
+        return time.time() - oldest if oldest else 0
+
+    def stats(self):
+        return {'pending': len(self._changes), 'lag': self.lag(),
+                'coalesced': self.coalesced, 'flushed': self.flushed}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_change_buffer():
+    """Returns the process wide ChangeBuffer, flushed when Python exits."""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = ChangeBuffer()
+                atexit.register(_buffer.flush)
+    return _buffer
+
+
+def _saved(sender, instance, **kw):
+    get_change_buffer().add(sender, instance.id, INDEX)
+
+
+def _deleted(sender, instance, **kw):
+    get_change_buffer().add(sender, instance.id, DELETE)
+
+
+def track(*models):
+    """
+    Keeps the index of `models` up to date through the change buffer::
+
+        from elasticutils import changes
+        changes.track(MyModel, OtherModel)
+    """
+    for model in models:
+        uid = 'elasticutils.changes.%s' % model._meta.db_table
+        signals.post_save.connect(_saved, sender=model, dispatch_uid=uid)
+        signals.post_delete.connect(_deleted, sender=model,
+                                    dispatch_uid=uid)
@@ -0,0 +1,42 @@
+"""
+Checkpoint stores remember which id ranges of a reindex run are done, so a
+crashed or interrupted run can pick up where it left off.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+
+class CacheCheckpointStore(object):
+    """
+    Keeps checkpoints in the Django cache.
+
+    Entries expire after ``ES_CHECKPOINT_TIMEOUT`` seconds (a week by
+    default), so a run that is abandoned for longer starts over.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or getattr(settings, 'ES_CHECKPOINT_TIMEOUT',
+                                          60 * 60 * 24 * 7)
+
+    def _key(self, run, range_):
+        return 'elasticutils:checkpoint:%s:%s-%s' % ((run,) + tuple(range_))
+
+    def completed(self, run, ranges):
+        """Returns the set of `ranges` that are marked as done for `run`."""
+        keys = dict((self._key(run, r), tuple(r)) for r in ranges)
+        return set(keys[k] for k in cache.get_many(keys.keys()))
+
+    def mark_done(self, run, range_):
+        cache.set(self._key(run, range_), 1, self.timeout)
+
+    def clear(self, run, ranges):
+        cache.delete_many([self._key(run, r) for r in ranges])
+
+
+def get_checkpoint_store():
+    """Returns an instance of the ``ES_CHECKPOINT_STORE`` class."""
+    path = getattr(settings, 'ES_CHECKPOINT_STORE',
+                   'elasticutils.checkpoints.CacheCheckpointStore')
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)()
@@ -1,8 +1,26 @@
+import logging
+
 from celery.task.sets import TaskSet
-from celeryutils import chunked
+from django.db.models import Max, Min
+
+from elasticutils.checkpoints import get_checkpoint_store
+
+log = logging.getLogger('elasticutils')
+
+
+def id_ranges(model, chunk_size):
+    """
+    Splits the ids of `model` into half-open ``(lo, hi)`` ranges spanning
+    `chunk_size` ids each, using only the smallest and largest id.
+    """
+    bounds = model.objects.aggregate(lo=Min('id'), hi=Max('id'))
+    if bounds['lo'] is None:
+        return []
+    return [(lo, lo + chunk_size)
+            for lo in xrange(bounds['lo'], bounds['hi'] + 1, chunk_size)]
 
 
-def reindex_objects(model, chunk_size=150):
+def reindex_objects(model, chunk_size=150, resume=False):
     """Creates methods that reindex all the objects in a model.
 
     For example in your ``myapp.cron.py`` you can do::
@@ -13,13 +31,31 @@ def reindex_objects(model, chunk_size=150):
 
         ./manage.py cron index_all_mymodels
 
+    Every range of ids is indexed by its own task, which records its
+    completion in the checkpoint store.  A run clears the checkpoints of
+    earlier runs and dispatches every range.  With ``resume=True`` only the
+    ranges that haven't been completed are dispatched, to finish a run that
+    was interrupted, e.g. from a second job registered with
+    ``reindex_objects(mymodel, resume=True)``.  Don't resume while tasks of
+    the run are still queued: their ranges aren't done yet, so they are
+    dispatched again.
     """
     def job():
         from elasticutils import tasks
 
-        ids = (model.objects.values_list('id', flat=True))
-        ts = [tasks.index_objects.subtask(args=[chunk])
-              for chunk in chunked(sorted(list(ids)), chunk_size)]
+        run = 'reindex:%s:%s' % (model._meta.db_table, chunk_size)
+        store = get_checkpoint_store()
+        ranges = id_ranges(model, chunk_size)
+        if resume:
+            done = store.completed(run, ranges)
+            pending = [r for r in ranges if r not in done]
+        else:
+            store.clear(run, ranges)
+            pending = ranges
+        log.info('Reindexing %s: %d of %d id ranges pending.' %
+                 (model._meta.db_table, len(pending), len(ranges)))
+        ts = [tasks.index_object_range.subtask(args=[model, lo, hi, run])
+              for lo, hi in pending]
         TaskSet(ts).apply_async()
 
     return job
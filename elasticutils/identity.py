@@ -0,0 +1,66 @@
+"""
+An identity map for model instances loaded from search results, so the same
+object isn't fetched from the database again by every search in a request.
+"""
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """
+    Model instances loaded so far, keyed by their model and id.  The model
+    can be any key standing for a model and the way it was loaded.
+    """
+
+    def __init__(self):
+        self._objects = {}
+
+    def get_many(self, model, ids):
+        """Returns a dict mapping the ids in `ids` that are known to objects."""
+        rv = {}
+        for id in ids:
+            obj = self._objects.get((model, id))
+            if obj is not None:
+                rv[id] = obj
+        return rv
+
+    def add(self, model, objs):
+        for obj in objs:
+            self._objects[model, obj.id] = obj
+
+    def __len__(self):
+        return len(self._objects)
+
+
+def get_identity_map():
+    """Returns the identity map of the current thread, or None."""
+    return getattr(_local, 'map', None)
+
+
+def activate():
+    """Starts a new identity map for the current thread."""
+    _local.map = IdentityMap()
+
+
+def deactivate():
+    """Drops the identity map of the current thread."""
+    _local.map = None
+
+
+@contextmanager
+def identity_map():
+    """
+    Shares model instances between the searches run inside the block, e.g.
+    in a Celery task.  Nested blocks use the outer map.
+    """
+    if get_identity_map() is not None:
+        yield get_identity_map()
+        return
+    activate()
+    try:
+        yield get_identity_map()
+    finally:
+        deactivate()
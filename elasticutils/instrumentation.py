@@ -0,0 +1,208 @@
+"""
+Hooks for measuring what elasticutils does.
+
+Listeners are callables taking the name of an event and a dict of data about
+it.  They are loaded from ``ES_INSTRUMENTATION`` or added with
+:func:`add_listener`.  A listener with an ``events`` attribute only gets the
+events named in it.  Times are in seconds, except ``took``, which is the
+milliseconds ElasticSearch reports.  The events are:
+
+``build``
+    An S was compiled into a query: ``doc_type``, ``elapsed``.
+``request``
+    An HTTP round trip: ``method``, ``path``, ``status``, ``elapsed``,
+    ``request_bytes``, ``response_bytes``.
+``decode``
+    A response was deserialized: ``bytes``, ``elapsed``.
+``search``
+    A search as a whole: ``doc_type``, ``index``, ``query``, ``took``,
+    ``elapsed``, ``hits``, ``cached``, ``coalesced`` (it shared the response
+    of an identical search in flight), ``origin``.
+``hydrate``
+    Model instances were loaded for results: ``doc_type``, ``objects``,
+    ``source``, ``elapsed``.
+``index``, ``unindex``
+    :class:`~elasticutils.models.SearchMixin` indexed or removed a
+    document: ``doc_type``, ``id``, ``elapsed``.
+``bulk``
+    A ``_bulk`` request: ``docs``, ``errors``, ``bytes``, ``elapsed``.
+``changes``
+    :func:`~elasticutils.tasks.apply_changes` applied a batch of changes:
+    ``doc_type``, ``indexed``, ``deleted``, ``errors``, ``elapsed`` and
+    ``lag``, the seconds since the oldest change was made.
+
+Events also carry the tags of the enclosing :func:`context` blocks, e.g.
+``doc_type`` and ``index`` for the requests of a search.
+"""
+import logging
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+try:
+    from statsd import statsd
+except ImportError:
+    statsd = None
+
+
+log = logging.getLogger('elasticsearch')
+
+_local = threading.local()
+_listeners = None
+_listeners_lock = threading.Lock()
+
+
+def get_listeners():
+    """Returns the list of listeners, loading ``ES_INSTRUMENTATION``."""
+    global _listeners
+    if _listeners is None:
+        with _listeners_lock:
+            if _listeners is None:
+                paths = getattr(settings, 'ES_INSTRUMENTATION', [
+                    'elasticutils.instrumentation.StatsdListener',
+                    'elasticutils.instrumentation.SlowQueryLog'])
+                listeners = []
+                for path in paths:
+                    module, name = path.rsplit('.', 1)
+                    listeners.append(
+                        getattr(__import__(module, {}, {}, [name]), name)())
+                _listeners = listeners
+    return _listeners
+
+
+def add_listener(listener):
+    """Adds `listener`, unless it's already listening."""
+    listeners = get_listeners()
+    with _listeners_lock:
+        if listener not in listeners:
+            listeners.append(listener)
+
+
+def remove_listener(listener):
+    listeners = get_listeners()
+    with _listeners_lock:
+        listeners.remove(listener)
+
+
+def _wants(listener, event):
+    events = getattr(listener, 'events', None)
+    return events is None or event in events
+
+
+def enabled(event=None):
+    """
+    Returns whether anybody listens, to `event` if given, so costly data can
+    be skipped.
+    """
+    return any(event is None or _wants(listener, event)
+               for listener in get_listeners())
+
+
+def emit(event, **data):
+    """
+    Sends `event` to every listener wanting it.  Listeners can't break
+    requests.
+    """
+    listeners = [listener for listener in get_listeners()
+                 if _wants(listener, event)]
+    if not listeners:
+        return
+    for key, value in current_tags().items():
+        data.setdefault(key, value)
+    for listener in listeners:
+        try:
+            listener(event, data)
+        except Exception:
+            log.exception('Instrumentation listener %r failed.' % listener)
+
+
+def current_tags():
+    return getattr(_local, 'tags', None) or {}
+
+
+@contextmanager
+def context(**tags):
+    """Adds `tags` to the events emitted by the current thread in the block."""
+    old = current_tags()
+    _local.tags = dict(old, **tags)
+    try:
+        yield
+    finally:
+        _local.tags = old
+
+
+def origin():
+    """Returns ``file:line in function`` of the code calling elasticutils."""
+    frame = sys._getframe(1)
+    while frame and frame.f_globals.get('__name__', '').startswith(
+            'elasticutils'):
+        frame = frame.f_back
+    if frame:
+        return '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno,
+                                frame.f_code.co_name)
+
+
+class StatsdListener(object):
+    """
+    Sends the time ElasticSearch took for searches to statsd as ``search``
+    and counts coalesced ones as ``es.search.coalesced``.  Searches and bulk
+    requests about a doc type are also timed as ``es.search.<doc_type>`` and
+    ``es.bulk.<doc_type>``.
+
+    The events named in `events` (``ES_STATSD_EVENTS``, none by default),
+    e.g. ``build`` or ``request``, are timed in detail: as ``es.<event>`` and
+    as ``es.<event>.<doc_type>`` for events about a doc type, with request
+    sizes going to ``es.request.bytes``.  That sends a few packets for every
+    search.
+    """
+
+    def __init__(self, events=None):
+        if events is None:
+            events = getattr(settings, 'ES_STATSD_EVENTS', ())
+        self.detailed = frozenset(events)
+        self.events = self.detailed | frozenset(['search', 'bulk'])
+
+    def __call__(self, event, data):
+        if statsd is None:
+            return
+        ms = int(data.get('elapsed', 0) * 1000)
+        if event in self.detailed:
+            statsd.timing('es.%s' % event, ms)
+            if data.get('doc_type'):
+                statsd.timing('es.%s.%s' % (event, data['doc_type']), ms)
+            if event == 'request':
+                statsd.incr('es.request.bytes',
+                            data['request_bytes'] + data['response_bytes'])
+        elif event in ('search', 'bulk') and data.get('doc_type'):
+            statsd.timing('es.%s.%s' % (event, data['doc_type']), ms)
+        if event == 'search' and data.get('coalesced'):
+            statsd.incr('es.search.coalesced')
+        elif event == 'search' and not data.get('cached'):
+            statsd.timing('search', data['took'])
+
+
+class SlowQueryLog(object):
+    """
+    Logs searches taking at least ``ES_SLOW_QUERY`` milliseconds (1000 by
+    default) to the ``elasticsearch.slow`` logger, with the query and the
+    code that ran it.
+    """
+    events = ('search',)
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        if threshold is None:
+            self.threshold = getattr(settings, 'ES_SLOW_QUERY', 1000)
+        self.log = logging.getLogger('elasticsearch.slow')
+
+    def __call__(self, event, data):
+        if event != 'search' or data['elapsed'] * 1000 < self.threshold:
+            return
+        self.log.warning('%dms (took %sms) %s/%s from %s: %s' % (
+            data['elapsed'] * 1000, data['took'], data.get('index'),
+            data.get('doc_type'), data.get('origin'), data.get('query')))
@@ -1,25 +1,81 @@
+import json
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
 from django.db.models import get_app, get_models
-from django.core.paginator import Paginator
 
+from elasticutils import bulk
 from elasticutils.models import SearchMixin
 
 class Command(BaseCommand):
     args = '<app app ...>'
     help = 'Indexes the specified applications for search.  Only indexes models utilizing the SearchMixin'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    help='Number of rows to read from the database at once.'),
+        make_option('--bulk-docs', type='int', dest='max_docs',
+                    help='Maximum number of documents per bulk request.'),
+        make_option('--bulk-bytes', type='int', dest='max_bytes',
+                    help='Maximum size in bytes of a bulk request.'),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    default=1,
+                    help='Number of bulk requests to keep in flight.'),
+        make_option('--rebuild', action='store_true', dest='rebuild',
+                    default=False,
+                    help='Build fresh indexes and switch their aliases to '
+                         'them once loaded, instead of indexing in place.'),
+        make_option('--index-settings', dest='index_settings',
+                    help='JSON settings for the indexes created by '
+                         '--rebuild, e.g. \'{"number_of_replicas": 2}\'.'),
+    )
 
     def handle(self, *args, **options):
+        models = []
         for app_name in args:
             try:
-                app = get_app(app_name) 
+                app = get_app(app_name)
             except ImproperlyConfigured:
                 raise CommandError('App "%s" does not exist or is improperly configured' % app_name)
+            models.extend(self.searchable_models(app))
+
+        if options['rebuild']:
+            return self.rebuild(models, options)
+
+        for searchable_model in models:
+            self.stdout.write('Indexing model %s\n' % searchable_model)
+            indexer = bulk.reindex(searchable_model,
+                                   **self.bulk_options(options))
+            self.stdout.write('Indexed %s\n' % indexer.summary())
+            for id, error in indexer.errors:
+                self.stderr.write('Failed to index %s: %s\n' % (id, error))
+
+    def rebuild(self, models, options):
+        index_settings = None
+        if options['index_settings']:
+            try:
+                index_settings = json.loads(options['index_settings'])
+            except ValueError as e:
+                raise CommandError('Invalid --index-settings: %s' % e)
+        # Every model stored in a rebuilt index has to be loaded into the new
+        # one, even if it lives in an app that wasn't named.
+        for alias in sorted(set(m._get_index() for m in models)):
+            stored = [m for m in self.searchable_models()
+                      if m._get_index() == alias]
+            self.stdout.write('Rebuilding %s with %s\n' % (alias, stored))
+            try:
+                new = bulk.rebuild_index(alias, stored, index_settings,
+                                         **self.bulk_options(options))
+            except bulk.RebuildFailed as e:
+                for id, error in e.errors:
+                    self.stderr.write('Failed to index %s: %s\n' % (id, error))
+                raise CommandError('%s was not rebuilt, %d errors.' %
+                                   (alias, len(e.errors)))
+            self.stdout.write('%s now points to %s\n' % (alias, new))
 
-            searchable_models = [model for model in get_models(app) if issubclass(model, SearchMixin)]
+    def searchable_models(self, app=None):
+        return [model for model in get_models(app) if issubclass(model, SearchMixin)]
 
-            for searchable_model in searchable_models:
-                self.stdout.write('Indexing model %s' % searchable_model)
-                count = searchable_model.objects.count()
-                index = searchable_model.index
-                for instance in searchable_model.objects.iterator():
-                    index(instance.fields)
+    def bulk_options(self, options):
+        return dict((key, options[key]) for key in
+                    ('chunk_size', 'max_docs', 'max_bytes', 'concurrency'))
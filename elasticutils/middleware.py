@@ -0,0 +1,48 @@
+import logging
+
+from elasticutils import identity, recorder
+
+
+log = logging.getLogger('elasticsearch.requests')
+
+
+class IdentityMapMiddleware(object):
+    """
+    Gives every request its own identity map, so model instances loaded by
+    one search are reused by the following ones instead of being fetched
+    from the database again.
+    """
+
+    def process_request(self, request):
+        identity.activate()
+
+    def process_response(self, request, response):
+        identity.deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        identity.deactivate()
+
+
+class QueryLogMiddleware(object):
+    """
+    Records the searches of every request (see :mod:`elasticutils.recorder`)
+    and logs how many ran and how long they took to the
+    ``elasticsearch.requests`` logger, with a warning for every search that
+    repeated an earlier one.
+    """
+
+    def process_request(self, request):
+        recorder.activate()
+
+    def process_response(self, request, response):
+        query_log = recorder.get_query_log()
+        if query_log:
+            log.info('%s: %s' % (request.path, query_log.summary()))
+            for query in query_log.queries:
+                if query['duplicate']:
+                    log.warning('%s: search from %s ran %d times before: %s'
+                                % (request.path, query['origin'],
+                                   query['duplicate'], query['query']))
+        recorder.deactivate()
+        return response
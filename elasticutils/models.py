@@ -1,8 +1,22 @@
-from django.conf import settings
+import datetime
+import time
 
 from pyes import djangoutils
 
 import elasticutils
+from elasticutils import instrumentation
+
+
+# What djangoutils.get_values stores as is; other values are stored as their
+# repr.
+SIMPLE_TYPES = (int, long, float, bool, str, unicode, list, dict, tuple,
+                type(None), datetime.date, datetime.time)
+
+
+def _overrides(cls, name):
+    method = getattr(cls, name)
+    return (getattr(method, '__func__', method) is not
+            getattr(SearchMixin, name).__func__)
 
 
 class SearchMixin(object):
@@ -10,8 +24,7 @@ class SearchMixin(object):
 
     @classmethod
     def _get_index(cls):
-        indexes = settings.ES_INDEXES
-        return indexes.get(cls._meta.db_table) or indexes['default']
+        return elasticutils.get_index(cls._meta.db_table)
 
     @classmethod
     def index(cls, document, id=None, bulk=False, force_insert=False):
@@ -23,19 +36,89 @@ class SearchMixin(object):
 
             MyModel.index(instance.fields, id=instance.id)
         """
+        start = time.time()
         elasticutils.get_es().index(
             document, index=cls._get_index(), doc_type=cls._meta.db_table,
             id=id, bulk=bulk, force_insert=force_insert)
+        instrumentation.emit('index', doc_type=cls._meta.db_table, id=id,
+                             elapsed=time.time() - start)
 
     @classmethod
     def unindex(cls, id):
         """Removes a particular item from the search index."""
+        start = time.time()
         elasticutils.get_es().delete(cls._get_index(), cls._meta.db_table, id)
+        instrumentation.emit('unindex', doc_type=cls._meta.db_table, id=id,
+                             elapsed=time.time() - start)
+
+    @classmethod
+    def from_source(cls, source):
+        """Builds an instance from an indexed document, without the database.
+
+        Used for results of ``S(...).hydrate(source=True)``.  Keys of
+        `source` that aren't model fields are ignored.  Foreign keys are
+        read from the field's name, where :meth:`fields` stores them, or
+        its ``attname`` (e.g. ``author_id``).
+
+        .. warning::
+            The instance only has what was indexed and may be out of date.
+            Override this method if ``fields`` doesn't store model fields
+            under their own names.
+        """
+        values = {}
+        for f in cls._meta.fields:
+            for key in (f.attname, f.name):
+                if key in source:
+                    values[str(f.attname)] = source[key]
+                    break
+        obj = cls(**values)
+        obj._state.adding = False
+        return obj
+
+    @classmethod
+    def serialize_many(cls, queryset):
+        """Yields ``(id, document)`` for every object in `queryset`.
+
+        This is how the indexing tasks, :func:`elasticutils.bulk.reindex` and
+        the ``index`` command serialize objects.  Unless :meth:`fields` is
+        overridden, the documents are built from ``queryset.values()`` rows,
+        the same as :meth:`fields` would build them, without creating model
+        instances.  Otherwise every object is loaded and :meth:`fields`
+        called.
+
+        Override it to serialize wide tables or related objects in bulk::
+
+            @classmethod
+            def serialize_many(cls, queryset):
+                rows = list(queryset.values('id', 'title', 'author_id'))
+                authors = dict(Author.objects.filter(
+                    id__in=set(r['author_id'] for r in rows))
+                    .values_list('id', 'name'))
+                for row in rows:
+                    yield row['id'], {'title': row['title'],
+                                      'author': authors.get(row['author_id'])}
+        """
+        if _overrides(cls, 'fields'):
+            for obj in queryset:
+                yield obj.id, obj.fields()
+            return
+        fields = [(f.attname, f.name) for f in cls._meta.fields]
+        pk = cls._meta.pk.attname
+        for row in queryset.values(*[attname for attname, name in fields]):
+            document = {'pk': row[pk]}
+            for attname, name in fields:
+                value = row[attname]
+                if not isinstance(value, SIMPLE_TYPES):
+                    value = repr(value)
+                document[name] = value
+            yield row[pk], document
 
     def fields(self):
         """Returns a serialization of a Model instance.
 
-        This can be used for indexing data.
+        This can be used for indexing data.  Overriding it makes
+        :meth:`serialize_many` load every object; override that as well when
+        indexing large numbers of objects.
 
         .. warning::
             It is recommended that you override this method and selectively
@@ -0,0 +1,54 @@
+"""
+A django-debug-toolbar panel listing the searches a request ran, with their
+queries, times, hits, the code that ran them and which ones were repeated.
+Add it to ``DEBUG_TOOLBAR_PANELS``::
+
+    DEBUG_TOOLBAR_PANELS = (
+        ...
+        'elasticutils.panels.SearchDebugPanel',
+    )
+"""
+import json
+
+from debug_toolbar.panels import DebugPanel
+from django.template.loader import render_to_string
+from pyes.es import ESJsonEncoder
+
+from elasticutils import recorder
+
+
+class SearchDebugPanel(DebugPanel):
+    name = 'ElasticSearch'
+    template = 'elasticutils/debug_toolbar.html'
+    has_content = True
+
+    def __init__(self, *args, **kw):
+        super(SearchDebugPanel, self).__init__(*args, **kw)
+        self.log = recorder.QueryLog()
+
+    def process_request(self, request):
+        recorder.activate()
+
+    def process_response(self, request, response):
+        self.log = recorder.get_query_log() or self.log
+        recorder.deactivate()
+
+    def nav_title(self):
+        return 'ElasticSearch'
+
+    def nav_subtitle(self):
+        return self.log.summary()
+
+    def title(self):
+        return 'ElasticSearch: %s' % self.log.summary()
+
+    def url(self):
+        return ''
+
+    def content(self):
+        queries = [dict(query, elapsed_ms=query['elapsed'] * 1000,
+                        json=json.dumps(query['query'], indent=2,
+                                        sort_keys=True, cls=ESJsonEncoder))
+                   for query in self.log.queries]
+        return render_to_string(self.template, {'log': self.log,
+                                                'queries': queries})
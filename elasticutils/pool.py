@@ -0,0 +1,426 @@
+"""
+A connection pool shared by the `ES` objects of every thread, with
+keep-alive connections, health tracking of the hosts in `ES_HOSTS`, failover
+between them and optional gzip compression.
+"""
+import errno
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+import zlib
+from itertools import count
+from Queue import Empty, LifoQueue
+
+from pyes.exceptions import NoServerAvailable
+from pyes.fakettypes import Method, RestResponse
+
+from elasticutils.breaker import (BudgetExceeded, CircuitBreaker,
+                                  ConnectError, ConnectionFailed, remaining)
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+
+log = logging.getLogger('elasticsearch')
+
+# Bytes of a streamed body collected into one HTTP chunk.
+CHUNK_SIZE = 64 * 1024
+
+# Bodies smaller than this aren't worth compressing.
+COMPRESS_MIN_SIZE = 1024
+
+# zlib level for compressed bodies; JSON shrinks well even at the fastest.
+COMPRESS_LEVEL = 1
+
+
+def _compressor():
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                            16 + zlib.MAX_WBITS)
+
+
+def gzip(data):
+    """Returns `data` compressed in the gzip format."""
+    compressor = _compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+class PoolExhausted(socket.timeout):
+    """No connection to a node became free in time."""
+
+
+class _StaleConnection(Exception):
+    """The node had closed the connection; `error` is what that caused."""
+
+    def __init__(self, error):
+        Exception.__init__(self, error)
+        self.error = error
+
+
+class Host(object):
+    """
+    One ElasticSearch node and its idle keep-alive connections.
+
+    At most `maxsize` connections to the node are open at a time; a request
+    that finds all of them busy waits for one to be returned.
+    """
+
+    def __init__(self, server, maxsize):
+        self.server = server
+        self.host, port = server.split(':')
+        self.port = int(port)
+        # LIFO, so the most recently used connection is reused first.
+        self._idle = LifoQueue(maxsize)
+        for i in range(maxsize):
+            self._idle.put(None)
+
+        self.dead_until = 0
+        self.failures = 0
+        self.requests = self.errors = 0
+        # Requests in a row that failed without an answer.
+        self.strikes = 0
+        # Body bytes as sent over the wire, i.e. compressed if they were.
+        self.bytes_sent = self.bytes_received = 0
+        # Exponentially weighted moving average of the request time.
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self):
+        return not self.failures
+
+    def request(self, method, uri, body, headers, timeout, compress=False):
+        """
+        Sends a request and returns ``(status, headers, body)``.  A `body`
+        that's a list of strings is streamed with chunked transfer encoding.
+        With `compress` the body is sent gzipped; gzipped responses are
+        always decompressed.
+
+        Raises `socket.error` or `httplib.HTTPException` if the request
+        fails; `ConnectError` means the node couldn't be reached at all and
+        `PoolExhausted` that all connections to it stayed busy.
+        """
+        if (compress and body and not isinstance(body, list) and
+                len(body) >= COMPRESS_MIN_SIZE):
+            body = gzip(body)
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        elif isinstance(body, list) and compress:
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        try:
+            conn = self._idle.get(timeout=timeout)
+        except Empty:
+            raise PoolExhausted('No free connection to %s.' % self.server)
+        try:
+            if conn is not None:
+                try:
+                    return self._send(conn, method, uri, body, headers,
+                                      timeout)
+                except _StaleConnection:
+                    # The node closed the idle connection before getting
+                    # the request, so it's safe to send it again.
+                    conn.close()
+                    conn = None
+                left = remaining()
+                if left is not None:
+                    if left <= 0:
+                        raise BudgetExceeded('Time budget exceeded.')
+                    timeout = min(timeout, left)
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=timeout)
+            try:
+                conn.connect()
+            except socket.error as e:
+                raise ConnectError(e)
+            # Streamed bodies are sent in several writes; without this the
+            # last one waits for the node's delayed ACK.
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                return self._send(conn, method, uri, body, headers, timeout)
+            except _StaleConnection as e:
+                raise e.error
+        except Exception:
+            if conn is not None:
+                conn.close()
+            self._idle.put(None)
+            raise
+
+    def _send(self, conn, method, uri, body, headers, timeout):
+        """
+        Sends the request on `conn`.  Raises `_StaleConnection` for errors
+        showing that the node had closed the connection, so it never got
+        the request; timeouts and other errors are raised as they are.
+        """
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        try:
+            if isinstance(body, list):
+                sent = self._send_chunked(conn, method, uri, body, headers)
+            else:
+                conn.request(method, uri, body, headers)
+                sent = len(body or '')
+        except socket.error as e:
+            if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                raise _StaleConnection(e)
+            raise
+        try:
+            response = conn.getresponse()
+        except httplib.BadStatusLine as e:
+            # The connection was closed without any response.
+            raise _StaleConnection(e)
+        data = response.read()
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += len(data)
+        if response.getheader('content-encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        # Nothing may fail after this: request() puts back a slot for
+        # every error.
+        self._idle.put(conn)
+        return response.status, dict(response.getheaders()), data
+
+    def _send_chunked(self, conn, method, uri, parts, headers):
+        """Streams `parts`, gzipped if `headers` say so.  Returns the size."""
+        conn.putrequest(method, uri)
+        for header, value in headers.items():
+            conn.putheader(header, value)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        compressor = None
+        if headers.get('Content-Encoding') == 'gzip':
+            compressor = _compressor()
+        chunk, size, sent = [], 0, 0
+        for part in parts:
+            chunk.append(part)
+            size += len(part)
+            if size >= CHUNK_SIZE:
+                sent += self._send_chunk(conn, ''.join(chunk), compressor)
+                chunk, size = [], 0
+        sent += self._send_chunk(conn, ''.join(chunk), compressor, last=True)
+        conn.send('0\r\n\r\n')
+        return sent
+
+    def _send_chunk(self, conn, data, compressor=None, last=False):
+        if compressor:
+            data = compressor.compress(data)
+            if last:
+                data += compressor.flush()
+        # An empty chunk would end the body.
+        if data:
+            conn.send('%x\r\n%s\r\n' % (len(data), data))
+        return len(data)
+
+
+class ConnectionPool(object):
+    """
+    Sends requests to the nodes in `servers`, with the interface pyes
+    expects from `ES.connection`.
+
+    Hosts are picked with the `selector` strategy: ``round_robin`` or
+    ``least_latency``.  A host that can't be reached is marked dead and the
+    request is retried on another one.  Dead hosts are left alone for
+    `dead_timeout` seconds, doubling with every consecutive failure up to
+    `max_dead_timeout`, and must pass a health check before they get
+    requests again.  A host that accepts connections but fails
+    `max_errors` requests in a row without answering, e.g. by timing out,
+    is marked dead as well.
+
+    Every request also goes through a
+    :class:`~elasticutils.breaker.CircuitBreaker` (unless `ES_BREAKER` is
+    False), so requests fail fast while the cluster is failing.  Requests
+    failing on one node while another one works are left to the failover
+    and aren't counted by the breaker.
+
+    Requests that fail without an answer raise
+    :class:`~elasticutils.breaker.ConnectionFailed`.
+
+    With `compress` (``ES_COMPRESS``) request bodies of at least
+    `COMPRESS_MIN_SIZE` bytes are gzipped and gzipped responses are asked
+    for, which the nodes send if ``http.compression`` is enabled.
+    """
+
+    def __init__(self, servers, timeout=None, maxsize=None, selector=None,
+                 dead_timeout=None, max_dead_timeout=None, compress=None,
+                 max_errors=None):
+        self.timeout = timeout or getattr(settings, 'ES_TIMEOUT', 1)
+        maxsize = maxsize or getattr(settings, 'ES_POOL_SIZE', 10)
+        self.hosts = [Host(server, maxsize) for server in servers]
+        self.selector = selector or getattr(settings, 'ES_POOL_SELECTOR',
+                                            'round_robin')
+        self.dead_timeout = dead_timeout or getattr(
+            settings, 'ES_DEAD_TIMEOUT', 5)
+        self.max_dead_timeout = max_dead_timeout or getattr(
+            settings, 'ES_MAX_DEAD_TIMEOUT', 300)
+        self.max_errors = max_errors or getattr(
+            settings, 'ES_MAX_HOST_ERRORS', 3)
+        self.compress = compress
+        if compress is None:
+            self.compress = getattr(settings, 'ES_COMPRESS', False)
+        self._counter = count()
+        self._lock = threading.Lock()
+        self.breaker = None
+        if getattr(settings, 'ES_BREAKER', True):
+            self.breaker = CircuitBreaker()
+
+    def execute(self, request):
+        """Executes a pyes `RestRequest` and returns a `RestResponse`."""
+        if self.breaker is None:
+            return self._execute(request)
+        self.breaker.before()
+        try:
+            response = self._execute(request)
+        except (BudgetExceeded, PoolExhausted):
+            # Nothing was sent, so these don't tell about the cluster.
+            self.breaker.cancel()
+            raise
+        except Exception:
+            if self._healthy():
+                self.breaker.cancel()
+            else:
+                self.breaker.failure()
+            raise
+        if response.status >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
+    def _execute(self, request):
+        uri = request.uri
+        if request.parameters:
+            uri += '?' + urllib.urlencode(request.parameters)
+        method = Method._VALUES_TO_NAMES[request.method]
+        headers = request.headers or {}
+        if self.compress:
+            headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+        tried = []
+        while True:
+            timeout = self.timeout
+            left = remaining()
+            if left is not None:
+                if left <= 0:
+                    raise BudgetExceeded('Time budget exceeded.')
+                timeout = min(timeout, left)
+            host = self._select(tried)
+            tried.append(host)
+            start = time.time()
+            try:
+                status, response_headers, body = host.request(
+                    method, uri, request.body, headers, timeout,
+                    self.compress)
+            except ConnectError as e:
+                self.mark_dead(host, e)
+                continue
+            except (BudgetExceeded, PoolExhausted):
+                raise
+            except (socket.error, httplib.HTTPException) as e:
+                self.mark_failed(host, e)
+                raise ConnectionFailed(e)
+            self.mark_alive(host, time.time() - start)
+            return RestResponse(status=status, headers=response_headers,
+                                body=body)
+
+    def _healthy(self):
+        """Returns whether a host is alive and answered its last request."""
+        with self._lock:
+            return any(h.alive and not h.strikes for h in self.hosts)
+
+    def _select(self, exclude=()):
+        now = time.time()
+        with self._lock:
+            live = [h for h in self.hosts
+                    if h.alive and h not in exclude]
+            revivable = sorted([h for h in self.hosts
+                                if not h.alive and h not in exclude],
+                               key=lambda h: h.dead_until)
+        for host in revivable:
+            # Hosts whose backoff is over get a health check first.
+            if host.dead_until <= now and self.check(host):
+                return host
+        if not live:
+            log.critical('No ElasticSearch nodes available.')
+            raise NoServerAvailable()
+        if self.selector == 'least_latency':
+            return min(live, key=lambda h: h.latency)
+        return live[self._counter.next() % len(live)]
+
+    def check(self, host):
+        """Returns whether `host` answers, and updates its health."""
+        start = time.time()
+        try:
+            status, headers, body = host.request('GET', '/', None, {},
+                                                 min(self.timeout, 1))
+        except (socket.error, httplib.HTTPException) as e:
+            self.mark_dead(host, e)
+            return False
+        if status != 200:
+            self.mark_dead(host, status)
+            return False
+        log.info('ElasticSearch node %s is back.' % host.server)
+        self.mark_alive(host, time.time() - start)
+        return True
+
+    def mark_dead(self, host, error):
+        with self._lock:
+            host.errors += 1
+            host.failures += 1
+            host.strikes = 0
+            backoff = min(self.dead_timeout * 2 ** (host.failures - 1),
+                          self.max_dead_timeout)
+            host.dead_until = time.time() + backoff
+        log.warning('ElasticSearch node %s is down (%s), retrying in %ds.' %
+                    (host.server, error, backoff))
+
+    def mark_failed(self, host, error):
+        """
+        Records a request to `host` that failed without an answer.  The host
+        is marked dead once `max_errors` of them failed in a row, so a node
+        that hangs doesn't keep getting its share of the requests.
+        """
+        with self._lock:
+            host.strikes += 1
+            dead = host.strikes >= self.max_errors
+            if not dead:
+                host.errors += 1
+        if dead:
+            self.mark_dead(host, error)
+
+    def mark_alive(self, host, elapsed):
+        with self._lock:
+            host.requests += 1
+            host.failures = host.strikes = 0
+            host.latency = (elapsed if not host.latency
+                            else 0.8 * host.latency + 0.2 * elapsed)
+
+    def stats(self):
+        """Returns a list with a dict of statistics for every host."""
+        now = time.time()
+        return [{'server': h.server,
+                 'alive': h.alive,
+                 'requests': h.requests,
+                 'errors': h.errors,
+                 'failures': h.failures,
+                 'dead_for': max(0, h.dead_until - now) if h.failures else 0,
+                 'latency_ms': h.latency * 1000,
+                 'bytes_sent': h.bytes_sent,
+                 'bytes_received': h.bytes_received,
+                 'idle_connections': len([c for c in list(h._idle.queue)
+                                          if c is not None])}
+                for h in self.hosts]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """Returns the process wide pool for the nodes in `ES_HOSTS`."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(settings.ES_HOSTS)
+    return _pool
@@ -0,0 +1,101 @@
+"""
+Records the searches run while handling a request, to find pages running
+redundant or slow searches.
+
+:class:`~elasticutils.middleware.QueryLogMiddleware` and the debug toolbar
+panel in :mod:`elasticutils.panels` activate a :class:`QueryLog` for every
+request.  Searches run in other threads, e.g. by
+:func:`~elasticutils.execute_concurrently`, aren't recorded.
+"""
+import os
+import threading
+import traceback
+
+from elasticutils import instrumentation
+from elasticutils.cache import cache_key
+
+
+_local = threading.local()
+
+# Frames from files in here are left out of the recorded stacks.
+_package = os.path.dirname(os.path.abspath(__file__))
+
+# The most frames of a stack that are kept, innermost first.
+STACK_DEPTH = 20
+
+
+class QueryLog(object):
+    """
+    The searches of one request, as dicts with the data of the ``search``
+    instrumentation event (``doc_type``, ``index``, ``query``, ``took``,
+    ``elapsed``, ``hits``, ``cached``, ``origin``), the ``stack`` that ran
+    them and ``duplicate``, the number of identical searches run before.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._seen = {}
+
+    def add(self, data):
+        key = cache_key(data['query'], data.get('index'), data.get('doc_type'))
+        duplicate = self._seen.get(key, 0)
+        self._seen[key] = duplicate + 1
+        self.queries.append(dict(data, stack=_stack(),
+                                 duplicate=duplicate))
+
+    @property
+    def elapsed(self):
+        """Seconds spent in searches."""
+        return sum(q['elapsed'] for q in self.queries)
+
+    @property
+    def duplicates(self):
+        """The number of searches that repeated an earlier one."""
+        return len([q for q in self.queries if q['duplicate']])
+
+    def summary(self):
+        return '%d searches (%d duplicates) in %.1fms' % (
+            len(self.queries), self.duplicates, self.elapsed * 1000)
+
+    def __len__(self):
+        return len(self.queries)
+
+
+def _stack():
+    """Returns the current stack, without elasticutils' own frames."""
+    frames = [f for f in traceback.extract_stack()
+              if not os.path.abspath(f[0]).startswith(_package)]
+    return frames[-STACK_DEPTH:]
+
+
+def record(event, data):
+    """The instrumentation listener adding searches to the active log."""
+    log = get_query_log()
+    if event == 'search' and log is not None:
+        log.add(data)
+
+record.events = ('search',)
+
+
+def get_query_log():
+    """Returns the active query log of the current thread, or None."""
+    return getattr(_local, 'log', None)
+
+
+def activate():
+    """
+    Starts recording the searches of the current thread.  Calls nest: the
+    log is kept until :func:`deactivate` has been called as often.
+    """
+    instrumentation.add_listener(record)
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    if _local.depth == 1:
+        _local.log = QueryLog()
+    return _local.log
+
+
+def deactivate():
+    """Stops recording, and drops the log once every activation ended."""
+    _local.depth = max(getattr(_local, 'depth', 0) - 1, 0)
+    if not _local.depth:
+        _local.log = None
@@ -0,0 +1,125 @@
+"""
+Serializers turning request bodies into JSON and responses back into
+Python, used for every request elasticutils sends.  The class is chosen with
+``ES_SERIALIZER``.
+"""
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    # Much faster than the json module of Python 2.6, and faster than the
+    # one of 2.7 when its C speedups are compiled.
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class JSONSerializer(object):
+    """
+    Serializes with simplejson if it's installed, and the json module
+    otherwise.
+
+    Dates, datetimes and Decimals are encoded the way pyes encodes them.
+    Unless `decode_dates` (``ES_DECODE_DATES``, True by default) is False,
+    strings in responses that look like datetimes are decoded into
+    datetimes, like pyes does; turning that off makes decoding much faster.
+    """
+
+    def __init__(self, decode_dates=None):
+        if decode_dates is None:
+            decode_dates = getattr(settings, 'ES_DECODE_DATES', True)
+        self.decode_dates = decode_dates
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=self.default, separators=(',', ':'))
+
+    def loads(self, s):
+        if self.decode_dates:
+            return json.loads(s, object_hook=self.object_hook)
+        return json.loads(s)
+
+    def default(self, value):
+        if isinstance(value, datetime):
+            return value.strftime(DATETIME_FORMAT)
+        elif isinstance(value, date):
+            return value.strftime('%Y-%m-%dT00:00:00')
+        elif isinstance(value, Decimal):
+            return float(str(value))
+        raise TypeError('%r is not JSON serializable' % value)
+
+    def object_hook(self, d):
+        for key, value in d.items():
+            # Cheap checks first, strptime is slow.
+            if (isinstance(value, basestring) and len(value) == 19 and
+                value[10:11] == 'T' and value[4:5] == '-'):
+                try:
+                    d[key] = datetime.strptime(value, DATETIME_FORMAT)
+                except ValueError:
+                    pass
+        return d
+
+
+class UJSONSerializer(JSONSerializer):
+    """
+    Decodes responses with ujson, which is several times faster than even
+    simplejson.  Request bodies are still encoded by :class:`JSONSerializer`,
+    since ujson silently turns datetimes into timestamps.
+    """
+
+    def __init__(self, decode_dates=None):
+        if ujson is None:
+            raise ImportError('UJSONSerializer needs ujson.')
+        super(UJSONSerializer, self).__init__(decode_dates)
+
+    def loads(self, s):
+        obj = ujson.loads(s)
+        if self.decode_dates:
+            self._decode_dates(obj)
+        return obj
+
+    def _decode_dates(self, obj):
+        if isinstance(obj, dict):
+            self.object_hook(obj)
+            values = obj.values()
+        elif isinstance(obj, list):
+            values = obj
+        else:
+            return
+        for value in values:
+            if isinstance(value, (dict, list)):
+                self._decode_dates(value)
+
+
+_serializer = None
+_serializer_lock = threading.Lock()
+
+
+def get_serializer():
+    """
+    Returns the process wide instance of the ``ES_SERIALIZER`` class
+    (``elasticutils.serializers.JSONSerializer`` by default).
+    """
+    global _serializer
+    if _serializer is None:
+        with _serializer_lock:
+            if _serializer is None:
+                path = getattr(settings, 'ES_SERIALIZER',
+                               'elasticutils.serializers.JSONSerializer')
+                module, name = path.rsplit('.', 1)
+                _serializer = getattr(__import__(module, {}, {}, [name]),
+                                      name)()
+    return _serializer
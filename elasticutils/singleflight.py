@@ -0,0 +1,134 @@
+"""
+Coalescing of identical searches running at the same time, so a popular
+query whose cached result just expired is sent to ElasticSearch once rather
+than by every thread that wants it.
+"""
+import cPickle as pickle
+import logging
+import threading
+
+from elasticutils.breaker import BudgetExceeded
+from elasticutils.pool import PoolExhausted
+
+try:
+    from django.conf import settings
+except ImportError:
+    import es_settings as settings
+
+
+log = logging.getLogger('elasticsearch')
+
+# Errors that say something about the thread making the call rather than
+# about ElasticSearch, like its own time budget running out.
+LOCAL_ERRORS = (BudgetExceeded, PoolExhausted)
+
+
+class _Call(object):
+    """A call in flight, which the threads asking for the same key wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key at a time.  Threads asking for a key that is
+    already being fetched wait for that call and get a copy of its result,
+    or its exception.  Results have to be picklable; waiters get the
+    pickling error otherwise.  If the calling thread is interrupted by
+    something other than an ``Exception`` or fails with one of
+    `LOCAL_ERRORS`, the waiters make the call themselves.
+
+    A thread waits at most `timeout` seconds (``ES_SINGLE_FLIGHT_TIMEOUT``,
+    5 by default) before making the call itself.  `calls`, `coalesced` and
+    `timeouts` count what happened.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        if timeout is None:
+            self.timeout = getattr(settings, 'ES_SINGLE_FLIGHT_TIMEOUT', 5)
+        self.calls = self.coalesced = self.timeouts = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, f, timeout=None):
+        """
+        Returns ``(result, coalesced)``: what `f` returned, here or in the
+        thread that was already calling it for `key`, and whether it was the
+        latter.  `timeout` can only shorten the wait.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                call.waiters += 1
+                leader = False
+
+        if leader:
+            try:
+                result = f()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                try:
+                    with self._lock:
+                        del self._calls[key]
+                    # Nobody can start waiting now.  The copy is taken before
+                    # this thread can modify the result.
+                    if call.waiters and call.error is None:
+                        try:
+                            call.result = pickle.dumps(
+                                result, pickle.HIGHEST_PROTOCOL)
+                        except Exception as e:
+                            log.exception('Could not copy a search result.')
+                            call.error = e
+                finally:
+                    call.done.set()
+            return result, False
+
+        wait = self.timeout if timeout is None else min(timeout, self.timeout)
+        if not call.done.wait(wait):
+            with self._lock:
+                self.timeouts += 1
+            log.warning('Gave up waiting %.1fs for an identical search.' %
+                        wait)
+            return f(), False
+        if call.error is not None:
+            if (isinstance(call.error, Exception) and
+                not isinstance(call.error, LOCAL_ERRORS)):
+                raise call.error
+            # The other thread was interrupted or ran out of its own time
+            # budget, so there is no result for this one.
+            return f(), False
+        return pickle.loads(call.result), True
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced,
+                'timeouts': self.timeouts, 'in_flight': len(self._calls)}
+
+
+_flight = None
+_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """
+    Returns the process wide SingleFlight for searches, or None if
+    ``ES_SINGLE_FLIGHT`` is False.
+    """
+    global _flight
+    if not getattr(settings, 'ES_SINGLE_FLIGHT', True):
+        return None
+    if _flight is None:
+        with _flight_lock:
+            if _flight is None:
+                _flight = SingleFlight()
+    return _flight
@@ -1,9 +1,18 @@
 import logging
+import os
+import socket
+import time
 
 from django.conf import settings
 
-import elasticutils
 from celeryutils import task
+from elasticutils import bulk, instrumentation
+from elasticutils.checkpoints import get_checkpoint_store
+
+try:
+    from statsd import statsd
+except ImportError:
+    statsd = None
 
 log = logging.getLogger('elasticutils')
 
@@ -22,18 +31,113 @@ def index_objects(model, ids, **kw):
     """
     if settings.ES_DISABLED:
         return
-    es = elasticutils.get_es()
+    if not ids:
+        return []
     log.info('Indexing objects %s-%s. [%s]' % (ids[0], ids[-1], len(ids)))
-    qs = model.objects.filter(id__in=ids)
-    for item in qs:
-        model.index(item.fields(), bulk=True, id=item.id)
-    es.flush_bulk(forced=True)
+    index, doc_type = model._get_index(), model._meta.db_table
+    with instrumentation.context(doc_type=doc_type, index=index,
+                                 task='index_objects'):
+        indexer = bulk.BulkIndexer()
+        for id, document in model.serialize_many(
+                model.objects.filter(id__in=ids)):
+            indexer.index(index, doc_type, id, document)
+        indexer.close()
+    return _failed(indexer, 'index', model)
+
+
+@task
+def index_object_range(model, lo, hi, run=None, **kw):
+    """Indexes the objects with ``lo <= id < hi``.
+
+    This is what :func:`elasticutils.cron.reindex_objects` runs for each
+    range.  If the range is indexed without errors and `run` is given, the
+    range is marked as done in the checkpoint store.
+    """
+    if settings.ES_DISABLED:
+        return
+    worker = '%s.%s' % (socket.gethostname(), os.getpid())
+    start = time.time()
+    qs = model.objects.filter(id__gte=lo, id__lt=hi)
+    with instrumentation.context(task='index_object_range'):
+        indexer = bulk.reindex(model, queryset=qs)
+    elapsed = time.time() - start
+    log.info('[%s] Indexed %s ids %s-%s: %s' %
+             (worker, model._meta.db_table, lo, hi, indexer.summary()))
+    if statsd:
+        statsd.incr('reindex.%s' % socket.gethostname().replace('.', '_'),
+                    indexer.docs)
+        statsd.timing('reindex.range', int(elapsed * 1000))
+    if run and not indexer.errors:
+        get_checkpoint_store().mark_done(run, (lo, hi))
 
 
 @task
 def unindex_objects(model, ids, **kw):
+    """Removes the objects with the given `ids` from the index.
+
+    The deletes are sent in ``_bulk`` requests.  Returns the list of ids that
+    could not be removed.
+    """
     if settings.ES_DISABLED:
         return
-    for id in ids:
-        log.info('Removing object [%s.%d] from search index.' % (model, id))
-        elasticutils.get_es().delete(model._get_index(), model._meta.db_table, id)
+    if not ids:
+        return []
+    log.info('Removing objects %s-%s from search index. [%s]' %
+             (ids[0], ids[-1], len(ids)))
+    index, doc_type = model._get_index(), model._meta.db_table
+    with instrumentation.context(doc_type=doc_type, index=index,
+                                 task='unindex_objects'):
+        indexer = bulk.BulkIndexer()
+        for id in ids:
+            indexer.delete(index, doc_type, id)
+        indexer.close()
+    return _failed(indexer, 'unindex', model)
+
+
+@task
+def apply_changes(model, index_ids, delete_ids, queued_at=None, **kw):
+    """Indexes and removes the objects collected by the change buffer.
+
+    Both go out through one :class:`~elasticutils.bulk.BulkIndexer`.
+    Objects to index that no longer exist are removed from the index.
+    `queued_at` is when the oldest change was made; the time since is
+    logged and sent to statsd as ``search.changes.lag``.  Returns the ids
+    that failed.
+    """
+    if settings.ES_DISABLED:
+        return
+    start = time.time()
+    index, doc_type = model._get_index(), model._meta.db_table
+    with instrumentation.context(doc_type=doc_type, index=index,
+                                 task='apply_changes'):
+        indexer = bulk.BulkIndexer()
+        found = set()
+        if index_ids:
+            for id, document in model.serialize_many(
+                    model.objects.filter(id__in=index_ids)):
+                indexer.index(index, doc_type, id, document)
+                found.add(id)
+        for id in list(delete_ids) + [i for i in index_ids if i not in found]:
+            indexer.delete(index, doc_type, id)
+        indexer.close()
+    if queued_at:
+        lag = time.time() - queued_at
+        log.info('Applied %d changes to %s, %.1fs after the first.' %
+                 (len(index_ids) + len(delete_ids), doc_type, lag))
+        if statsd:
+            statsd.timing('search.changes.lag', int(lag * 1000))
+        instrumentation.emit(
+            'changes', doc_type=doc_type, lag=lag, indexed=len(found),
+            elapsed=time.time() - start,
+            deleted=len(delete_ids) + len(index_ids) - len(found),
+            errors=len(indexer.errors))
+    return _failed(indexer, 'apply changes to', model)
+
+
+def _failed(indexer, action, model):
+    """Logs and returns the ids that `indexer` failed to process."""
+    failed = [id for id, error in indexer.errors]
+    if failed:
+        log.error('Failed to %s %d objects of %s: %s' %
+                  (action, len(failed), model._meta.db_table, failed))
+    return failed
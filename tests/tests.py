@@ -3,21 +3,83 @@ Run me using nose!
 
 Also run elastic search on the default ports locally.
 """
+import errno
+import json
+import logging
+import socket
+import threading
+import time
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from unittest import TestCase
 
-from elasticutils import F, S, get_es
+from django.conf import settings
+
+import elasticutils
+from elasticutils import (F, S, UNAVAILABLE_ERRORS, es_required_or_50x,
+                          execute_concurrently, execute_many, get_es,
+                          get_index)
+from elasticutils.breaker import (BudgetExceeded, CircuitBreaker,
+                                  CircuitOpen, ConnectionFailed, deadline,
+                                  is_transient, with_retries)
+from elasticutils import bulk
+from elasticutils.bulk import BulkIndexer, RebuildFailed, rebuild_index
+from elasticutils.cache import LRUCache, cache_key, get_result_cache
+from elasticutils import instrumentation, recorder, serializers
+from elasticutils.identity import get_identity_map, identity_map
+from elasticutils.middleware import QueryLogMiddleware
+from elasticutils.models import SearchMixin
+from elasticutils.pool import ConnectionPool, PoolExhausted, gzip
+from elasticutils.serializers import JSONSerializer
+from elasticutils.singleflight import SingleFlight
+from pyes.fakettypes import RestRequest, RestResponse
+from elasticutils.changes import DELETE, INDEX, ChangeBuffer
+from elasticutils.checkpoints import CacheCheckpointStore
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_
 
 import pyes.exceptions
 
+try:
+    from elasticutils import tasks
+except ImportError:
+    # The tasks need celeryutils.
+    tasks = None
+
+try:
+    from elasticutils import cron
+except ImportError:
+    # The cron jobs need celery.
+    cron = None
+
 class Meta(object):
     def __init__(self, db_table):
         self.db_table = db_table
 
 
+class QuerySet(list):
+    """Records what was asked of it, like select_related."""
+    calls = ()
+
+    def select_related(self, *fields):
+        self.calls += (('select_related', fields),)
+        return self
+
+    def only(self, *fields):
+        self.calls += (('only', fields),)
+        return self
+
+
 class Manager(object):
+    queries = []
+
     def filter(self, id__in=None):
-        return [m for m in model_cache if m.id in id__in]
+        qs = QuerySet(m for m in model_cache if m.id in id__in)
+        self.queries.append(qs)
+        return qs
 
 model_cache = []
 
@@ -32,6 +94,1610 @@ class FakeModel(object):
         model_cache.append(self)
 
 
+class FakeES(object):
+    """Records the requests that would have been sent to ElasticSearch."""
+    encoder = None
+
+    def __init__(self, *responses):
+        self.requests = []
+        self.params = []
+        self.responses = list(responses)
+
+    def _send_request(self, method, path, body=None, params={}):
+        self.requests.append((method, path, body))
+        self.params.append(params)
+        if self.responses:
+            rv = self.responses.pop(0)
+            if isinstance(rv, Exception):
+                raise rv
+            return rv
+        return {}
+
+    def create_index(self, index, settings=None):
+        return self._send_request('PUT', '/%s' % index, settings)
+
+    def delete_index(self, index):
+        return self._send_request('DELETE', '/%s' % index)
+
+    def get_alias(self, alias):
+        status = self._send_request('GET', '/%s/_status' % alias)
+        return status['indices'].keys()
+
+    def change_aliases(self, commands):
+        return self._send_request('POST', '/_aliases', {'actions': [
+            {command: {'index': index, 'alias': alias}}
+            for command, index, alias in commands]})
+
+    def search(self, query, indexes=None, doc_types=None, **params):
+        return self._send_request('GET', '/%s/%s/_search' % (indexes, doc_types),
+                                  query, params)
+
+
+def response(total=0, hits=(), **kw):
+    """Returns a search response with the given `hits` (dicts)."""
+    rv = {'took': 1, 'hits': {'total': total, 'hits': list(hits)}}
+    rv.update(kw)
+    return rv
+
+
+class FakeESTestCase(TestCase):
+    """Makes get_es() return a FakeES with `responses` during each test."""
+    responses = ()
+
+    def setUp(self):
+        self.es = FakeES(*self.responses)
+        self.old_get_es = elasticutils.get_es
+        elasticutils.get_es = lambda: self.es
+
+    def tearDown(self):
+        elasticutils.get_es = self.old_get_es
+
+
+class BulkIndexerTest(TestCase):
+
+    def test_flush_by_docs(self):
+        es = FakeES()
+        indexer = BulkIndexer(es=es, max_docs=2)
+        for id in range(5):
+            indexer.index('test', 'fake', id, {'id': id})
+        indexer.close()
+        eq_(len(es.requests), 3)
+        eq_(es.requests[0][:2], ('POST', '/_bulk'))
+        eq_(es.requests[0][2].count('\n'), 4)
+        eq_(indexer.docs, 5)
+        eq_(indexer.batches, 3)
+
+    def test_concurrency(self):
+        es = FakeES()
+        indexer = BulkIndexer(es=es, max_docs=10, concurrency=3)
+        for id in range(95):
+            indexer.index('test', 'fake', id, {'id': id})
+        indexer.close()
+        eq_(len(es.requests), 10)
+        eq_(indexer.docs, 95)
+
+    def test_flush_by_bytes(self):
+        es = FakeES()
+        indexer = BulkIndexer(es=es, max_docs=100, max_bytes=100)
+        for id in range(4):
+            indexer.index('test', 'fake', id, {'foo': 'x' * 30})
+        indexer.close()
+        eq_(len(es.requests), 4)
+
+    def test_errors(self):
+        es = FakeES({'items': [
+            {'delete': {'_id': 1, 'ok': True}},
+            {'delete': {'_id': 2, 'error': 'boom'}}]})
+        indexer = BulkIndexer(es=es)
+        indexer.delete('test', 'fake', 1)
+        indexer.delete('test', 'fake', 2)
+        indexer.close()
+        eq_(indexer.docs, 1)
+        eq_(indexer.errors, [(2, 'boom')])
+
+    def test_failed_request(self):
+        for concurrency in (1, 2):
+            es = FakeES(socket.error('Connection reset'))
+            indexer = BulkIndexer(es=es, max_docs=2, concurrency=concurrency)
+            for id in range(4):
+                indexer.index('test', 'fake', id, {'id': id})
+            indexer.close()
+            eq_(len(es.requests), 2)
+            eq_(indexer.docs, 2)
+            # With workers either batch can be sent first.
+            eq_(len(indexer.errors), 2)
+            eq_(indexer.errors[0][1], 'Connection reset')
+
+
+class RebuildIndexTest(FakeESTestCase):
+    missing = pyes.exceptions.IndexMissingException('IndexMissingException')
+
+    def rebuild(self, index_settings=None):
+        new = rebuild_index('main', [], index_settings)
+        assert new.startswith('main-')
+        return new
+
+    def test_alias(self):
+        self.es.responses = [
+            {'main-1': {'settings': {'index.number_of_replicas': '2',
+                                     'index.refresh_interval': '5s'}}},
+            {}, {}, {}, {'indices': {'main-1': {}}}]
+        new = self.rebuild()
+        methods = [(method, path) for method, path, body in self.es.requests]
+        eq_(methods, [('GET', '/main/_settings'), ('PUT', '/' + new),
+                      ('PUT', '/%s/_settings' % new),
+                      ('POST', '/%s/_refresh' % new),
+                      ('GET', '/main/_status'), ('POST', '/_aliases'),
+                      ('DELETE', '/main-1')])
+        eq_(self.es.requests[1][2]['settings'],
+            {'number_of_replicas': 0, 'refresh_interval': '-1'})
+        eq_(self.es.requests[2][2],
+            {'index': {'number_of_replicas': '2', 'refresh_interval': '5s'}})
+        eq_(self.es.requests[5][2]['actions'],
+            [{'remove': {'index': 'main-1', 'alias': 'main'}},
+             {'add': {'index': new, 'alias': 'main'}}])
+
+    def test_index(self):
+        self.es.responses = [
+            {'main': {'settings': {'index.number_of_replicas': '0'}}},
+            {}, {}, {}, {'indices': {'main': {}}}]
+        new = self.rebuild({'number_of_shards': 3})
+        eq_(self.es.requests[1][2]['settings'],
+            {'number_of_shards': 3, 'number_of_replicas': 0,
+             'refresh_interval': '-1'})
+        eq_(self.es.requests[2][2],
+            {'index': {'number_of_replicas': '0', 'refresh_interval': '1s'}})
+        eq_(self.es.requests[5][:2], ('DELETE', '/main'))
+        eq_(self.es.requests[6][2]['actions'],
+            [{'add': {'index': new, 'alias': 'main'}}])
+        eq_(len(self.es.requests), 7)
+
+    def test_missing(self):
+        self.es.responses = [self.missing, {}, {}, {}, self.missing]
+        new = self.rebuild({'number_of_replicas': 2})
+        eq_(self.es.requests[2][2],
+            {'index': {'number_of_replicas': 2, 'refresh_interval': '1s'}})
+        eq_(self.es.requests[5][2]['actions'],
+            [{'add': {'index': new, 'alias': 'main'}}])
+        eq_(len(self.es.requests), 6)
+
+    def rebuild_failing(self, fail):
+        """Rebuilds with a model whose load fails with `fail`."""
+        class Model(object):
+            _meta = Meta('fake')
+
+        def reindex(model, index=None, **kw):
+            indexer = BulkIndexer(max_docs=1)
+            indexer.index(index, 'fake', 1, {'id': 1})
+            indexer.close()
+            return indexer
+        old = bulk.reindex
+        bulk.reindex = reindex
+        try:
+            self.es.responses = [self.missing, {}, fail]
+            rebuild_index('main', [Model])
+        finally:
+            bulk.reindex = old
+
+    def test_failed_batch(self):
+        try:
+            self.rebuild_failing(socket.error('Connection reset'))
+        except RebuildFailed as e:
+            eq_(e.errors, [(1, 'Connection reset')])
+        else:
+            assert False, 'Expected RebuildFailed.'
+        new = self.es.requests[1][1]
+        methods = [(method, path) for method, path, body in self.es.requests]
+        # The alias isn't touched and only the new index is deleted.
+        eq_(methods, [('GET', '/main/_settings'), ('PUT', new),
+                      ('POST', '/_bulk'), ('DELETE', new)])
+
+    def test_failed_actions(self):
+        self.assertRaises(RebuildFailed, self.rebuild_failing, {'items': [
+            {'index': {'_id': 1, 'error': 'MapperParsingException'}}]})
+        eq_(self.es.requests[-1][0], 'DELETE')
+        eq_(len(self.es.requests), 4)
+
+
+class Searchable(SearchMixin):
+    _meta = Meta('fake')
+
+
+class UnindexTest(FakeESTestCase):
+
+    def setUp(self):
+        if tasks is None:
+            raise SkipTest
+        super(UnindexTest, self).setUp()
+        settings.ES_DISABLED = False
+
+    def tearDown(self):
+        del settings.ES_DISABLED
+        super(UnindexTest, self).tearDown()
+
+    def test_empty(self):
+        eq_(tasks.unindex_objects(Searchable, []), [])
+        eq_(self.es.requests, [])
+
+    def test_partial_failure(self):
+        self.es.responses = [{'items': [
+            {'delete': {'_id': 1, 'ok': True}},
+            {'delete': {'_id': 2, 'error': 'boom'}}]}]
+        eq_(tasks.unindex_objects(Searchable, [1, 2]), [2])
+        method, path, body = self.es.requests[0]
+        eq_((method, path), ('POST', '/_bulk'))
+        eq_([json.loads(line) for line in body.splitlines()],
+            [{'delete': {'_index': 'test', '_type': 'fake', '_id': i}}
+             for i in (1, 2)])
+        eq_(len(self.es.requests), 1)
+
+
+class CheckpointTest(TestCase):
+
+    def test_completed(self):
+        store = CacheCheckpointStore()
+        ranges = [(1, 11), (11, 21), (21, 31)]
+        store.mark_done('run', (11, 21))
+        eq_(store.completed('run', ranges), set([(11, 21)]))
+        eq_(store.completed('other', ranges), set())
+        store.clear('run', ranges)
+        eq_(store.completed('run', ranges), set())
+
+
+class RangeManager(object):
+    """Answers the queries of the reindex coordinator for a list of ids."""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.filters = []
+
+    def aggregate(self, lo, hi):
+        return {'lo': min(self.ids) if self.ids else None,
+                'hi': max(self.ids) if self.ids else None}
+
+    def filter(self, **kw):
+        self.filters.append(kw)
+        return QuerySet()
+
+
+def range_model(ids):
+    class Model(object):
+        _meta = Meta('ranged')
+        objects = RangeManager(ids)
+    return Model
+
+
+class ReindexObjectsTest(TestCase):
+
+    def setUp(self):
+        if cron is None:
+            raise SkipTest
+        self.dispatched = []
+        self.old_taskset = cron.TaskSet
+        cron.TaskSet = self.task_set
+        # Stands in for elasticutils.tasks, which needs celeryutils.
+        self.old_tasks = getattr(elasticutils, 'tasks', None)
+        elasticutils.tasks = self
+        self.index_object_range = self
+        self.store = CacheCheckpointStore()
+        self.model = range_model([3, 250])
+        self.run = 'reindex:ranged:100'
+        self.ranges = [(3, 103), (103, 203), (203, 303)]
+
+    def tearDown(self):
+        cron.TaskSet = self.old_taskset
+        elasticutils.tasks = self.old_tasks
+        self.store.clear(self.run, self.ranges)
+
+    def subtask(self, args):
+        return tuple(args)
+
+    def task_set(self, subtasks):
+        test = self
+
+        class TaskSet(object):
+            def apply_async(self):
+                test.dispatched.extend(subtasks)
+        return TaskSet()
+
+    def test_id_ranges(self):
+        eq_(cron.id_ranges(range_model([]), 100), [])
+        # Only the smallest and largest id matter, gaps included.
+        eq_(cron.id_ranges(self.model, 100), self.ranges)
+        eq_(cron.id_ranges(range_model([7]), 100), [(7, 107)])
+
+    def test_run(self):
+        self.store.mark_done(self.run, (3, 103))
+        cron.reindex_objects(self.model, chunk_size=100)()
+        # A new run starts over.
+        eq_(self.dispatched, [(self.model, lo, hi, self.run)
+                              for lo, hi in self.ranges])
+        eq_(self.store.completed(self.run, self.ranges), set())
+
+    def test_resume(self):
+        self.store.mark_done(self.run, (103, 203))
+        cron.reindex_objects(self.model, chunk_size=100, resume=True)()
+        eq_(self.dispatched, [(self.model, 3, 103, self.run),
+                              (self.model, 203, 303, self.run)])
+        eq_(self.store.completed(self.run, self.ranges), set([(103, 203)]))
+
+    def test_empty(self):
+        cron.reindex_objects(range_model([]), chunk_size=100)()
+        eq_(self.dispatched, [])
+
+
+class IndexObjectRangeTest(TestCase):
+
+    def setUp(self):
+        if tasks is None:
+            raise SkipTest
+        settings.ES_DISABLED = False
+        self.store = CacheCheckpointStore()
+        self.old_reindex = bulk.reindex
+        bulk.reindex = self.reindex
+        self.errors = []
+
+    def tearDown(self):
+        del settings.ES_DISABLED
+        bulk.reindex = self.old_reindex
+        self.store.clear('run', [(1, 11)])
+
+    def reindex(self, model, queryset=None, **kw):
+        indexer = BulkIndexer(es=FakeES())
+        indexer.errors = self.errors
+        return indexer
+
+    def test_done(self):
+        model = range_model(range(1, 11))
+        tasks.index_object_range(model, 1, 11, 'run')
+        eq_(model.objects.filters, [{'id__gte': 1, 'id__lt': 11}])
+        eq_(self.store.completed('run', [(1, 11)]), set([(1, 11)]))
+
+    def test_errors(self):
+        self.errors = [(4, 'boom')]
+        tasks.index_object_range(range_model(range(1, 11)), 1, 11, 'run')
+        eq_(self.store.completed('run', [(1, 11)]), set())
+
+    def test_no_run(self):
+        tasks.index_object_range(range_model(range(1, 11)), 1, 11)
+        eq_(self.store.completed('run', [(1, 11)]), set())
+
+
+class ChangeBufferTest(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.buffer = ChangeBuffer(max_size=3, max_age=60,
+                                   handler=self.handle)
+
+    def tearDown(self):
+        self.buffer.flush()
+
+    def handle(self, model, index_ids, delete_ids, queued_at):
+        self.batches.append((model, index_ids, delete_ids))
+
+    def test_coalesce(self):
+        self.buffer.add(FakeModel, 1)
+        self.buffer.add(FakeModel, 1)
+        self.buffer.add(FakeModel, 2, DELETE)
+        self.buffer.add(FakeModel, 2, INDEX)
+        eq_(self.batches, [])
+        eq_(self.buffer.stats()['coalesced'], 2)
+        self.buffer.add(FakeModel, 1, DELETE)
+        self.buffer.add(Meta, 3)
+        eq_(sorted(self.batches), sorted([(FakeModel, [2], [1]),
+                                          (Meta, [3], [])]))
+        eq_(self.buffer.stats()['flushed'], 3)
+
+    def test_max_age(self):
+        self.buffer.max_age = 0.05
+        self.buffer.add(FakeModel, 1)
+        assert self.buffer.lag() < 0.05
+        self.buffer._timer.join(1)
+        eq_(self.batches, [(FakeModel, [1], [])])
+        eq_(self.buffer.stats()['pending'], 0)
+
+
+class Field(object):
+    def __init__(self, name, attname=None):
+        self.name, self.attname = name, attname or name
+
+
+class ValuesQuerySet(list):
+    """Holds rows as dicts and only hands them out through values()."""
+
+    def __iter__(self):
+        raise AssertionError('Instances should not be loaded.')
+
+    def values(self, *fields):
+        return [dict((f, row[f]) for f in fields)
+                for row in list.__iter__(self)]
+
+
+class SerializeManyTest(TestCase):
+
+    def test_values(self):
+        class Searchable(SearchMixin):
+            _meta = Meta('searchable')
+            _meta.fields = [Field('id'), Field('price'),
+                            Field('author', 'author_id')]
+            _meta.pk = _meta.fields[0]
+
+        qs = ValuesQuerySet([{'id': 1, 'price': Decimal('2.5'),
+                              'author_id': 7, 'extra': 'x'}])
+        eq_(list(Searchable.serialize_many(qs)),
+            [(1, {'pk': 1, 'id': 1, 'price': "Decimal('2.5')",
+                  'author': 7})])
+
+    def test_fields(self):
+        class Searchable(SearchMixin):
+            def __init__(self, id):
+                self.id = id
+
+            def fields(self):
+                return {'double': self.id * 2}
+
+        eq_(list(Searchable.serialize_many([Searchable(1), Searchable(2)])),
+            [(1, {'double': 2}), (2, {'double': 4})])
+
+
+class SingleFlightTest(TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight(timeout=5)
+        self.release = threading.Event()
+        self.results = []
+
+    def lead(self, f):
+        """Starts a call of `f` for 'key' that waits for self.release."""
+        def slow():
+            self.release.wait(5)
+            return f()
+        thread = threading.Thread(target=self.follow, args=(slow,))
+        thread.start()
+        while not self.flight.stats()['in_flight']:
+            pass
+        return thread
+
+    def follow(self, f, timeout=None):
+        try:
+            self.results.append(self.flight.do('key', f, timeout))
+        except BaseException as e:
+            self.results.append(e)
+
+    def test_coalesce(self):
+        response = {'took': 1}
+        threads = [self.lead(lambda: response)]
+        for i in range(3):
+            threads.append(threading.Thread(target=self.follow,
+                                            args=(lambda: {'took': 2},)))
+            threads[-1].start()
+        while self.flight.stats()['coalesced'] < 3:
+            pass
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        eq_(sorted(coalesced for r, coalesced in self.results),
+            [False, True, True, True])
+        eq_([r for r, coalesced in self.results], [response] * 4)
+        # Every thread gets its own copy.
+        eq_(len(set(id(r) for r, coalesced in self.results)), 4)
+        eq_(self.flight.stats(), {'calls': 1, 'coalesced': 3, 'timeouts': 0,
+                                  'in_flight': 0})
+
+    def test_error(self):
+        def fail():
+            raise ValueError('down')
+        threads = [self.lead(fail),
+                   threading.Thread(target=self.follow,
+                                    args=(lambda: 'not called',))]
+        threads[1].start()
+        while not self.flight.stats()['coalesced']:
+            pass
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        eq_([type(r) for r in self.results], [ValueError, ValueError])
+
+    def test_interrupted(self):
+        class Interrupted(BaseException):
+            pass
+
+        def interrupt():
+            raise Interrupted()
+        threads = [self.lead(interrupt),
+                   threading.Thread(target=self.follow,
+                                    args=(lambda: 'own',))]
+        threads[1].start()
+        while not self.flight.stats()['coalesced']:
+            pass
+        start = time.time()
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        assert time.time() - start < 1
+        # The threads finish in either order.
+        eq_(len(self.results), 2)
+        assert ('own', False) in self.results
+        assert [r for r in self.results if isinstance(r, Interrupted)]
+        eq_(self.flight.stats()['in_flight'], 0)
+
+    def test_budget_not_shared(self):
+        def over_budget():
+            raise BudgetExceeded('Time budget exceeded.')
+        threads = [self.lead(over_budget),
+                   threading.Thread(target=self.follow,
+                                    args=(lambda: 'own',))]
+        threads[1].start()
+        while not self.flight.stats()['coalesced']:
+            pass
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        eq_(len(self.results), 2)
+        assert ('own', False) in self.results
+        assert [r for r in self.results if isinstance(r, BudgetExceeded)]
+
+    def test_unpicklable(self):
+        lock = threading.Lock()
+        threads = [self.lead(lambda: lock),
+                   threading.Thread(target=self.follow,
+                                    args=(lambda: 'not called',))]
+        threads[1].start()
+        while not self.flight.stats()['coalesced']:
+            pass
+        start = time.time()
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        assert time.time() - start < 1
+        eq_(len(self.results), 2)
+        assert (lock, False) in self.results
+        assert [r for r in self.results if isinstance(r, Exception)]
+
+    def test_timeout(self):
+        thread = self.lead(lambda: 'slow')
+        self.follow(lambda: 'own', timeout=0.01)
+        self.release.set()
+        thread.join()
+        eq_(self.results, [('own', False), ('slow', False)])
+        eq_(self.flight.stats()['timeouts'], 1)
+
+
+class GetIndexTest(TestCase):
+
+    def test_default(self):
+        eq_(get_index('fake'), 'test')
+
+
+class CacheTest(TestCase):
+
+    def test_lru(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        eq_(cache.get('a'), 1)
+        cache.set('c', 3, 60)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 1)
+        eq_(cache.stats(), {'hits': 2, 'misses': 1, 'size': 2})
+
+    def test_copies(self):
+        cache = LRUCache()
+        response = {'hits': {'hits': [{'_source': {'title': 'taco'}}]}}
+        cache.set('a', response, 60)
+        response['hits']['hits'][0]['_source']['title'] = 'changed'
+        eq_(cache.get('a'),
+            {'hits': {'hits': [{'_source': {'title': 'taco'}}]}})
+        cache.get('a')['hits'] = None
+        eq_(cache.get('a')['hits']['hits'][0]['_source']['title'], 'taco')
+
+    def test_expiry(self):
+        cache = LRUCache()
+        cache.set('a', 1, -1)
+        eq_(cache.get('a'), None)
+
+    def test_key(self):
+        eq_(cache_key({'a': 1, 'b': 2}, 'test', 'fake'),
+            cache_key({'b': 2, 'a': 1}, 'test', 'fake'))
+        assert (cache_key({'a': 1}, 'test', 'fake') !=
+                cache_key({'a': 1}, 'test', 'other'))
+
+    def test_raw(self):
+        s = S(FakeModel).filter(tag='cached').cache()
+        response = {'took': 1, 'hits': {'total': 0, 'hits': []}}
+        key = cache_key(s._build_query(), 'test', 'fake')
+        get_result_cache().set(key, response, 60)
+        eq_(s.raw(), response)
+        eq_(len(s), 0)
+
+
+class FTest(TestCase):
+
+    def test_immutable(self):
+        a = F(tag='a') | F(style='b')
+        b = a | F(price=1)
+        c = a | F(price=2)
+        eq_(len(a.filters['or']), 2)
+        eq_(b.filters['or'][-1], {'term': {'price': 1}})
+        eq_(c.filters['or'][-1], {'term': {'price': 2}})
+
+    def test_flatten(self):
+        f = (F(a=1) & F(b=2)) & (F(c=3) & F(d=4))
+        eq_(len(f.filters['and']), 4)
+        f = (F(a=1) | F(b=2)) | (F(c=3) | F(d=4)) | ~F(e=5)
+        eq_(len(f.filters['or']), 5)
+
+    def test_collapse_terms(self):
+        f = F(style='x')
+        for i in range(100):
+            f = f | F(tag=i)
+        f = f | F(tag__in=[5, 200]) | F(tag=200)
+        eq_(f.filters, {'or': [{'term': {'style': 'x'}},
+                               {'in': {'tag': list(range(100)) + [200]}}]})
+        # AND'ed terms on one field mean something else.
+        eq_(len((F(tag=1) & F(tag=2)).filters['and']), 2)
+
+    def test_dedupe(self):
+        f = F(price__gt=5) & F(tag='a') & F(price__gt=5)
+        eq_(f.filters, {'and': [{'range': {'price': {'gt': 5}}},
+                                {'term': {'tag': 'a'}}]})
+        eq_((F(tag='a') | F(tag='a')).filters, {'term': {'tag': 'a'}})
+        eq_((F() | F(tag='a')).filters, {'term': {'tag': 'a'}})
+        # Values that only compare equal in Python aren't duplicates.
+        eq_(len((F(flag=1) & F(flag=True)).filters['and']), 2)
+        f = (F(tag__in=['a', 'b']) & F(price__lt=9) &
+             F(tag__in=('a', 'b')) & F(price__lt=9))
+        eq_(f.filters, {'and': [{'in': {'tag': ['a', 'b']}},
+                                {'range': {'price': {'lt': 9}}}]})
+        # Unhashable values are compared as JSON.
+        eq_((F(tag=[{'a': 1}]) & F(tag=[{'a': 1}])).filters,
+            {'term': {'tag': [{'a': 1}]}})
+        eq_(len((F(tag=[{'a': 1}]) & F(tag=[{'a': 2}])).filters['and']), 2)
+
+    def test_linear(self):
+        def compose(n):
+            start = time.time()
+            f = F(price__gt=0)
+            for i in range(n):
+                f = f | F(price__gt=i) | F(tag=i)
+            eq_(len(f.filters['or']), n + 1)
+            return time.time() - start
+        compose(500)
+        small, large = compose(1000), compose(4000)
+        # Quadratic composition would take 16 times as long.
+        assert large < small * 8, (small, large)
+
+
+def filtered(filter_, query=None):
+    """Returns a filtered query, the way S compiles filters."""
+    return {'filtered': {'query': query or {'match_all': {}},
+                         'filter': filter_}}
+
+
+class BuildQueryTest(TestCase):
+
+    def test_memoized(self):
+        s = S(FakeModel).filter(tag='awesome')
+        eq_(s._build_query() is s._build_query(), True)
+        eq_(s[:5]._build_query(),
+            {'query': filtered({'term': {'tag': 'awesome'}}),
+             'fields': [], 'size': 5})
+
+    def test_clones_independent(self):
+        s = S(FakeModel).filter(tag='awesome')
+        s._build_query()
+        a = s.filter(foo='bar')
+        b = s.query(foo='car')
+        eq_(a._build_query()['query'], filtered(
+            {'and': [{'term': {'tag': 'awesome'}}, {'term': {'foo': 'bar'}}]}))
+        eq_(b._build_query()['query'], filtered({'term': {'tag': 'awesome'}},
+                                                {'term': {'foo': 'car'}}))
+        eq_(s._build_query(), {'query': filtered({'term': {'tag': 'awesome'}}),
+                               'fields': []})
+
+    def test_extra(self):
+        s = S(FakeModel).extra(filter={'tag': 'awesome'}, values=['foo'])
+        qs = s._build_query()
+        eq_(qs['query'], filtered({'term': {'tag': 'awesome'}}))
+        eq_(qs['fields'], ['id', 'foo'])
+
+    def test_facet_not_modified(self):
+        facet = {'terms': {'field': 'tag'}, 'global': True}
+        qs = S(FakeModel).filter(tag='awesome').facet(tags=facet, other={})
+        facets = qs._build_query()['facets']
+        eq_(facets['tags']['facet_filter'], {'term': {'tag': 'awesome'}})
+        eq_(facets['other'], {})
+        eq_(facet, {'terms': {'field': 'tag'}, 'global': True})
+
+    def test_post_filter(self):
+        s = (S(FakeModel).query(title='taco').filter(tag='awesome')
+             .facet(tags={'terms': {}},
+                    styles={'terms': {}, 'facet_filter': {'term': {'a': 1}}})
+             .post_filter())
+        qs = s._build_query()
+        eq_(qs['query'], {'term': {'title': 'taco'}})
+        eq_(qs['filter'], {'term': {'tag': 'awesome'}})
+        eq_(qs['facets'], {
+            'tags': {'terms': {},
+                     'facet_filter': {'term': {'tag': 'awesome'}}},
+            'styles': {'terms': {}, 'facet_filter': {'term': {'a': 1}}}})
+        eq_(s.post_filter(False)._build_query()['query'],
+            filtered({'term': {'tag': 'awesome'}},
+                     {'term': {'title': 'taco'}}))
+
+    def test_filter_cache(self):
+        s = S(FakeModel).filter(F(tag='a').filter_cache(False),
+                                F(price__gt=5) | F(price__lt=1))
+        filter_ = s._build_query()['query']['filtered']['filter']
+        eq_(filter_['and'][0], {'term': {'tag': 'a', '_cache': False}})
+        filter_ = s.filter_cache(key='hot')._build_query()['query']
+        filter_ = filter_['filtered']['filter']
+        eq_(filter_['and']['_cache_key'], 'hot')
+        eq_(len(filter_['and']['filters']), 2)
+
+    def test_filter_cache_combined(self):
+        f = (F(tag='a') | F(price__gt=5)).filter_cache()
+        eq_(f.filters['or']['_cache'], True)
+        # A cached group stays a group.
+        eq_((f | F(tag='b')).filters,
+            {'or': [f.filters, {'term': {'tag': 'b'}}]})
+
+    def test_long_chain(self):
+        s = S(FakeModel)
+        for i in range(3000):
+            s = s.filter(id=i)
+        eq_(len(s._build_query()['query']['filtered']['filter']['and']), 3000)
+
+
+class CountTest(FakeESTestCase):
+
+    def test_count_from_sibling(self):
+        self.es.responses = [response(42, [{'_id': 1, '_source': {'id': 1}}])]
+        s = S(FakeModel).filter(tag='awesome').values_dict()
+        page = s[:10]
+        eq_(len(page), 1)
+        eq_(s.count(), 42)
+        eq_(s[10:20].count(), 42)
+        eq_(len(self.es.requests), 1)
+        eq_(len(s.filter(foo='bar')._shared), 0)
+
+    def test_count_not_kept(self):
+        self.es.responses = [response(42, [{'_id': 1, '_source': {'id': 1}}]),
+                             response(43), response(44)]
+        s = S(FakeModel).values_dict()
+        eq_(len(s[:10]), 1)
+        # The slice and its results are gone, so the total isn't reused.
+        eq_(s.count(), 43)
+        eq_(s.count(), 44)
+        eq_(len(self.es.requests), 3)
+
+    def test_count_empty(self):
+        self.es.responses = [response(0)]
+        s = S(FakeModel).values_dict()
+        eq_(len(s), 0)
+        eq_(s.count(), 0)
+        eq_(len(self.es.requests), 1)
+
+    def test_paginate(self):
+        hits = [{'_id': i, '_source': {'id': i}} for i in range(20, 30)]
+        self.es.responses = [response(35, hits)]
+        page = S(FakeModel).values_dict().paginate(3, per_page=10)
+        eq_(self.es.requests[0][2]['from'], 20)
+        eq_(self.es.requests[0][2]['size'], 10)
+        eq_(len(page), 10)
+        eq_(page.count, 35)
+        eq_(page.num_pages, 4)
+        eq_(page.has_next(), True)
+        eq_(page.has_previous(), True)
+
+    def test_paginate_invalid(self):
+        s = S(FakeModel).values_dict()
+        self.assertRaises(ValueError, s.paginate, 0, 10)
+        self.assertRaises(ValueError, s.paginate, 1, 0)
+        eq_(self.es.requests, [])
+
+
+class FacetTest(FakeESTestCase):
+    facets = {
+        'tags': {'_type': 'terms', 'terms': [{'term': 'taco', 'count': 3}]},
+        'prices': {'_type': 'range',
+                   'ranges': [{'from': 0, 'to': 5, 'count': 2}]},
+        'days': {'_type': 'date_histogram',
+                 'entries': [{'time': 1330560000000, 'count': 4}]},
+        'stats': {'_type': 'statistical', 'count': 2, 'min': 1, 'max': 3},
+        'cheap': {'_type': 'filter', 'count': 7},
+        'nearby': {'_type': 'geo_distance', 'ranges': []},
+        'other': {'_type': 'unknown', 'x': 1},
+    }
+
+    def test_facets_only(self):
+        del Manager.queries[:]
+        self.es.responses = [response(42, facets=self.facets)]
+        s = S(FakeModel).order_by('name').facet(tags={'terms': {}})
+        page = s[10:20]
+        facets = page.facets
+        eq_(facets, {'tags': [{'term': 'taco', 'count': 3}],
+                     'prices': [{'from': 0, 'to': 5, 'count': 2}],
+                     'days': [{'time': 1330560000000, 'count': 4}],
+                     'stats': {'count': 2, 'min': 1, 'max': 3},
+                     'cheap': 7, 'nearby': [],
+                     'other': {'_type': 'unknown', 'x': 1}})
+        eq_(s.facets, facets)
+        eq_(s.count(), 42)
+        eq_(len(self.es.requests), 1)
+        eq_(self.es.requests[0][2], {'facets': {'tags': {'terms': {}}},
+                                     'size': 0})
+        eq_(Manager.queries, [])
+
+    def test_facets_not_shared_later(self):
+        cheap = {'cheap': self.facets['cheap']}
+        self.es.responses = [response(1, facets=cheap),
+                             response(2, facets={})]
+        s = S(FakeModel).facet(tags={'terms': {}})
+        eq_(s[:10].facets, {'cheap': 7})
+        # A new slice searches again once the old one is gone.
+        eq_(s[:10].facets, {})
+        eq_(len(self.es.requests), 2)
+
+    def test_facets_from_results(self):
+        self.es.responses = [response(1, [{'_id': 1, '_source': {'id': 1}}],
+                                      facets=self.facets)]
+        s = S(FakeModel).values_dict().facet(tags={'terms': {}})
+        list(s)
+        eq_(s.facets['cheap'], 7)
+        eq_(len(self.es.requests), 1)
+
+
+class TrimTest(FakeESTestCase):
+
+    def test_source(self):
+        s = S(FakeModel).values_dict().source(include=['title', 'tag*'],
+                                              exclude=['body'])
+        eq_(s._build_query(), {'_source': {'include': ['title', 'tag*'],
+                                           'exclude': ['body']}})
+        eq_(s.source(exclude=['body'])._build_query(),
+            {'_source': {'exclude': ['body']}})
+
+    def test_filter_path(self):
+        # The list of hits is left out when there are none.
+        self.es.responses = [{'took': 1, 'hits': {'total': 0}}]
+        s = S(FakeModel).filter_path('hits.hits._score')
+        eq_(list(s), [])
+        paths = self.es.params[0]['filter_path'].split(',')
+        assert 'hits.hits._score' in paths
+        assert 'hits.hits._id' in paths
+
+
+class ExecuteManyTest(FakeESTestCase):
+
+    def test_msearch(self):
+        self.es.responses = [{'responses': [
+            response(1, [{'_id': 1, '_source': {'id': 1}}]),
+            response(2, [{'_id': 2, 'fields': {'id': 2, 'tag': 'b'}},
+                         {'_id': 3, 'fields': {'id': 3, 'tag': 'c'}}])]}]
+        a = S(FakeModel).filter(tag='a').values_dict()
+        b = S(FakeModel).filter(tag='b').values('tag')
+        eq_(execute_many([a, b]), [a, b])
+        eq_(len(self.es.requests), 1)
+        method, path, body = self.es.requests[0]
+        eq_(path, '/_msearch')
+        eq_(len(body.splitlines()), 4)
+        eq_(list(a), [{'id': 1}])
+        eq_(list(b), [(2, 'b'), (3, 'c')])
+        eq_(b.count(), 2)
+        eq_(len(self.es.requests), 1)
+
+    def test_error(self):
+        self.es.responses = [{'responses': [
+            {'error': 'SearchPhaseExecutionException'},
+            response(1, [{'_id': 1, '_source': {'id': 1}}])]}]
+        a = S(FakeModel).filter(tag='a').values_dict()
+        b = S(FakeModel).filter(tag='b').values_dict()
+        try:
+            execute_many([a, b])
+        except pyes.exceptions.ElasticSearchException:
+            pass
+        else:
+            assert False, 'Expected an ElasticSearchException.'
+        eq_(a._results_cache, None)
+        eq_(list(b), [{'id': 1}])
+
+
+class ExecuteAsyncTest(FakeESTestCase):
+
+    def test_execute_async(self):
+        self.es.responses = [response(1, [{'_id': 1, '_source': {'id': 1}}])]
+        s = S(FakeModel).values_dict()
+        results = s.execute_async().get(5)
+        eq_(list(results), [{'id': 1}])
+        eq_(list(s), [{'id': 1}])
+        eq_(len(self.es.requests), 1)
+
+    def test_execute_concurrently(self):
+        self.es.responses = [response(1, [{'_id': 1, '_source': {'id': 1}}])
+                             for i in range(3)]
+        searches = [S(FakeModel).filter(tag=i).values_dict()
+                    for i in range(3)]
+        execute_concurrently(searches, 5)
+        eq_(len(self.es.requests), 3)
+        eq_([s.count() for s in searches], [1, 1, 1])
+        eq_(len(self.es.requests), 3)
+
+
+class IteratorTest(FakeESTestCase):
+
+    def test_scroll(self):
+        self.es.responses = [
+            response(3, _scroll_id='a'),
+            response(3, [{'_id': 1, 'fields': {'id': 1, 'tag': 'x'}},
+                         {'_id': 2, 'fields': {'id': 2, 'tag': 'y'}}],
+                     _scroll_id='b'),
+            response(3, [{'_id': 3, 'fields': {'id': 3, 'tag': 'z'}}],
+                     _scroll_id='c'),
+            response(3, _scroll_id='d')]
+        s = S(FakeModel).order_by('tag').values('tag')[:1]
+        eq_(list(s.iterator(chunk_size=2)), [(1, 'x'), (2, 'y'), (3, 'z')])
+        query = self.es.requests[0][2]
+        eq_(query, {'fields': ['id', 'tag'], 'size': 2})
+        eq_([r[2] for r in self.es.requests[1:]], ['a', 'b', 'c'])
+
+    def test_identity_map_bypassed(self):
+        objs = [FakeModel(id=i + 200) for i in range(2)]
+        self.es.responses = [
+            response(2, _scroll_id='a'),
+            response(2, [{'_id': str(obj.id)} for obj in objs],
+                     _scroll_id='b'),
+            response(2, _scroll_id='c')]
+        try:
+            with identity_map() as objects:
+                eq_(list(S(FakeModel).iterator()), objs)
+                eq_(len(objects), 0)
+        finally:
+            for obj in objs:
+                model_cache.remove(obj)
+
+
+class SearchResultsTest(TestCase):
+
+    def test_lazy(self):
+        from elasticutils import ListSearchResults
+        raw = response(2, [{'_id': 1, 'fields': {'id': 1, 'tag': 'x'}},
+                           {'_id': 2, 'fields': {'id': 2, 'tag': 'y'}}])
+        results = ListSearchResults(FakeModel, raw, ['id', 'tag'])
+        eq_(len(results), 2)
+        eq_(results[1], (2, 'y'))
+        eq_(list(results), [(1, 'x'), (2, 'y')])
+        eq_(results._objects, None)
+        eq_(results.objects, [(1, 'x'), (2, 'y')])
+        eq_(results._hits, None)
+        eq_(results.results['hits'], {'total': 2, 'hits': []})
+        # The response itself may be cached, so it's left alone.
+        eq_(len(raw['hits']['hits']), 2)
+
+
+class HydrateTest(FakeESTestCase):
+
+    def setUp(self):
+        super(HydrateTest, self).setUp()
+        self.objs = [FakeModel(id=i + 100) for i in range(3)]
+        hits = [{'_id': str(obj.id), '_source': {'title': 'x'}}
+                for obj in reversed(self.objs)]
+        self.es.responses = [response(3, hits), response(3, hits)]
+        del Manager.queries[:]
+
+    def tearDown(self):
+        super(HydrateTest, self).tearDown()
+        for obj in self.objs:
+            model_cache.remove(obj)
+
+    def test_iterate_twice(self):
+        s = S(FakeModel)
+        eq_(list(s), self.objs[::-1])
+        eq_(list(s), self.objs[::-1])
+        eq_(len(Manager.queries), 1)
+
+    def test_identity_map(self):
+        with identity_map() as objs:
+            eq_(list(S(FakeModel)), self.objs[::-1])
+            eq_(list(S(FakeModel).filter(a=1)), self.objs[::-1])
+            eq_(len(objs), 3)
+        eq_(len(Manager.queries), 1)
+        eq_(get_identity_map(), None)
+
+    def test_identity_map_hydration(self):
+        self.es.responses.append(response(3, [{'_id': '100'}]))
+        with identity_map():
+            list(S(FakeModel).hydrate(only=['id']))
+            list(S(FakeModel))
+            list(S(FakeModel).hydrate(only=['id'],
+                                      select_related=['author'])[:1])
+        # The partly loaded instances aren't reused by the full search.
+        eq_([q.calls for q in Manager.queries],
+            [(('only', ('id',)),), (),
+             (('select_related', ('author',)), ('only', ('id',)))])
+
+    def test_queryset_hooks(self):
+        list(S(FakeModel).hydrate(select_related=('author',), only=['id']))
+        eq_(Manager.queries[0].calls,
+            (('select_related', ('author',)), ('only', ('id',))))
+
+    def test_from_source(self):
+        s = S(FakeModel).hydrate(source=True)
+        results = list(s)
+        eq_(Manager.queries, [])
+        eq_([(r.id, r.title) for r in results], [(102, 'x'), (101, 'x'),
+                                                  (100, 'x')])
+        assert 'fields' not in self.es.requests[0][2]
+        for obj in results:
+            model_cache.remove(obj)
+
+
+class FromSourceTest(TestCase):
+
+    def test_foreign_key(self):
+        class State(object):
+            adding = True
+
+        class Book(SearchMixin):
+            _meta = Meta('book')
+            _meta.fields = [Field('id'), Field('title'),
+                            Field('author', 'author_id')]
+
+            def __init__(self, **kw):
+                self.__dict__.update(kw)
+                self._state = State()
+
+        book = Book.from_source({'id': 1, 'title': 'x', 'author': 7,
+                                 'score': 2})
+        eq_((book.id, book.title, book.author_id), (1, 'x', 7))
+        assert not hasattr(book, 'author')
+        assert not hasattr(book, 'score')
+        eq_(book._state.adding, False)
+        eq_(Book.from_source({'author_id': 8}).author_id, 8)
+
+
+class InstrumentationTest(FakeESTestCase):
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        self.events = []
+        instrumentation.add_listener(self.listen)
+
+    def tearDown(self):
+        super(InstrumentationTest, self).tearDown()
+        instrumentation.remove_listener(self.listen)
+
+    def listen(self, event, data):
+        self.events.append((event, data))
+
+    def test_search(self):
+        self.es.responses = [response(1, [{'_id': 1, '_source': {'id': 1}}])]
+        list(S(FakeModel).filter(tag='a').values_dict())
+        eq_([e for e, data in self.events], ['build', 'search'])
+        data = self.events[1][1]
+        eq_(data['doc_type'], 'fake')
+        eq_(data['hits'], 1)
+        eq_(data['cached'], False)
+        assert 'test_search' in data['origin'], data['origin']
+
+    def test_broken_listener(self):
+        def broken(event, data):
+            raise ValueError()
+        instrumentation.add_listener(broken)
+        try:
+            self.es.responses = [response(0)]
+            eq_(list(S(FakeModel).values_dict()), [])
+        finally:
+            instrumentation.remove_listener(broken)
+
+    def test_context(self):
+        with instrumentation.context(task='x'):
+            indexer = BulkIndexer(es=FakeES(), concurrency=2)
+            indexer.index('test', 'fake', 1, {'id': 1})
+            indexer.close()
+        eq_(self.events[0][0], 'bulk')
+        eq_(self.events[0][1]['task'], 'x')
+        eq_(self.events[0][1]['docs'], 1)
+
+    def test_events(self):
+        def build_only(event, data):
+            self.events.append(('build_only', event))
+        build_only.events = ('build',)
+        instrumentation.add_listener(build_only)
+        try:
+            self.es.responses = [response(0)]
+            list(S(FakeModel).values_dict())
+        finally:
+            instrumentation.remove_listener(build_only)
+        eq_([e for e in self.events if e[0] == 'build_only'],
+            [('build_only', 'build')])
+        eq_([e for e, data in self.events if e != 'build_only'],
+            ['build', 'search'])
+        assert instrumentation.enabled('search')
+
+    def test_statsd(self):
+        sent = []
+
+        class Statsd(object):
+            def timing(self, name, value):
+                sent.append(name)
+
+            def incr(self, name, count=1):
+                sent.append(name)
+
+        data = {'elapsed': 0.01, 'doc_type': 'fake', 'took': 5,
+                'request_bytes': 10, 'response_bytes': 20}
+        old = instrumentation.statsd
+        instrumentation.statsd = Statsd()
+        try:
+            listener = instrumentation.StatsdListener()
+            for event in ('build', 'request', 'decode', 'search', 'hydrate',
+                          'index', 'bulk'):
+                if event in listener.events:
+                    listener(event, data)
+            eq_(sent, ['es.search.fake', 'search', 'es.bulk.fake'])
+
+            del sent[:]
+            instrumentation.StatsdListener(events=['request'])(
+                'request', data)
+            eq_(sent, ['es.request', 'es.request.fake', 'es.request.bytes'])
+        finally:
+            instrumentation.statsd = old
+
+    def test_slow_query_log(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        slow = instrumentation.SlowQueryLog(threshold=100)
+        slow.log.addHandler(handler)
+        try:
+            slow('search', {'elapsed': 0.05, 'took': 10})
+            eq_(records, [])
+            slow('search', {'elapsed': 0.2, 'took': 150, 'doc_type': 'fake',
+                            'query': {}})
+            eq_(len(records), 1)
+        finally:
+            slow.log.removeHandler(handler)
+
+
+class RecorderTest(FakeESTestCase):
+
+    def test_middleware(self):
+        class Request(object):
+            path = '/tacos'
+
+        self.es.responses = [response(1, [{'_id': 1, '_source': {'id': 1}}])
+                             for i in range(4)]
+        # Searches aren't recorded without an active log.
+        list(S(FakeModel).filter(tag='a').values_dict())
+        middleware = QueryLogMiddleware()
+        outer = recorder.activate()
+        middleware.process_request(Request())
+        for tag in ('a', 'a', 'b'):
+            list(S(FakeModel).filter(tag=tag).values_dict())
+        middleware.process_response(Request(), None)
+        # The log lives on until the outer activation ends.
+        eq_(recorder.get_query_log(), outer)
+        recorder.deactivate()
+        eq_(recorder.get_query_log(), None)
+        eq_([q['duplicate'] for q in outer.queries], [0, 1, 0])
+        eq_(outer.duplicates, 1)
+        eq_([q['hits'] for q in outer.queries], [1, 1, 1])
+        assert 'test_middleware' in outer.queries[0]['stack'][-1][2]
+        assert 'elasticutils' not in outer.queries[0]['stack'][-1][0]
+
+    def test_listen_once(self):
+        threads = [threading.Thread(target=recorder.activate)
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(instrumentation.get_listeners().count(recorder.record), 1)
+        self.es.responses = [response(0), response(0)]
+        list(S(FakeModel).values_dict())
+        log = recorder.activate()
+        list(S(FakeModel).values_dict())
+        recorder.deactivate()
+        eq_([q['duplicate'] for q in log.queries], [0])
+
+
+class SerializerTest(TestCase):
+
+    def test_dumps(self):
+        serializer = JSONSerializer()
+        eq_(json.loads(serializer.dumps({
+            'when': datetime(2012, 3, 1, 12, 30), 'day': date(2012, 3, 1),
+            'price': Decimal('1.5')})),
+            {'when': '2012-03-01T12:30:00', 'day': '2012-03-01T00:00:00',
+             'price': 1.5})
+
+    def test_loads(self):
+        data = '{"a": {"when": "2012-03-01T12:30:00", "x": "abcdefghijklmnopqrs"}}'
+        eq_(JSONSerializer().loads(data),
+            {'a': {'when': datetime(2012, 3, 1, 12, 30),
+                   'x': 'abcdefghijklmnopqrs'}})
+        eq_(JSONSerializer(decode_dates=False).loads(data)['a']['when'],
+            '2012-03-01T12:30:00')
+
+    def test_search_body(self):
+        class Serializer(JSONSerializer):
+            def dumps(self, data):
+                return 'serialized %s' % data.keys()
+
+        class Connection(object):
+            def execute(self, request):
+                self.body = request.body
+                return RestResponse(status=200, body='{}')
+
+        es = elasticutils.ElasticSearch(['127.0.0.1:9200'])
+        es.connection = Connection()
+        old = serializers._serializer
+        serializers._serializer = Serializer()
+        try:
+            es.search({'query': {}}, 'test', 'fake')
+        finally:
+            serializers._serializer = old
+        eq_(es.connection.body, "serialized ['query']")
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == '/slow':
+            time.sleep(0.5)
+        body = self.read_body()
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        body = json.dumps({'ok': True, 'path': self.path, 'body': body,
+                           'encoding': encoding})
+        self.send_response(200)
+        if self.path == '/badgzip':
+            self.send_header('Content-Encoding', 'gzip')
+        elif self.headers.get('Accept-Encoding') == 'gzip':
+            body = gzip(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/close':
+            # Hang up without telling the client, like an idle timeout.
+            self.close_connection = 1
+
+    do_POST = do_GET
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return ''.join(chunks)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeESServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.paths = []
+
+
+def free_port():
+    """Returns a local port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PoolTest(TestCase):
+
+    def setUp(self):
+        self.server = FakeESServer(('127.0.0.1', 0), FakeESHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.live = '127.0.0.1:%d' % self.server.server_port
+        self.dead = '127.0.0.1:%d' % free_port()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, pool, path='/test/_search'):
+        response = pool.execute(RestRequest(method=0, uri=path,
+                                            parameters={}, headers={},
+                                            body=''))
+        return json.loads(response.body)
+
+    def test_unavailable(self):
+        pool = ConnectionPool([self.live], timeout=1)
+
+        @es_required_or_50x('disabled', 'unavailable')
+        def view(request, path):
+            if path:
+                return self.request(pool, path)
+            raise socket.error('Memcached is down')
+
+        settings.ES_DISABLED = False
+        try:
+            eq_(view(None, '/test')['path'], '/test')
+            # Only errors of ElasticSearch's connections mean it's
+            # unavailable.
+            self.assertRaises(socket.error, view, None, None)
+            assert issubclass(ConnectionFailed, UNAVAILABLE_ERRORS)
+            assert not issubclass(socket.error, UNAVAILABLE_ERRORS)
+        finally:
+            del settings.ES_DISABLED
+
+    def test_keep_alive(self):
+        pool = ConnectionPool([self.live], timeout=1)
+        for i in range(3):
+            eq_(self.request(pool)['path'], '/test/_search')
+        stats = pool.stats()[0]
+        eq_(stats['requests'], 3)
+        eq_(stats['idle_connections'], 1)
+
+    def test_failover(self):
+        pool = ConnectionPool([self.dead, self.live], timeout=1)
+        for i in range(4):
+            eq_(self.request(pool)['ok'], True)
+        dead, live = pool.stats()
+        eq_(dead['alive'], False)
+        eq_(dead['errors'], 1)
+        eq_(live['requests'], 4)
+
+    def test_all_dead(self):
+        pool = ConnectionPool([self.dead], timeout=1)
+        for i in range(2):
+            try:
+                self.request(pool)
+            except pyes.exceptions.NoServerAvailable:
+                pass
+            else:
+                assert False, 'Expected NoServerAvailable.'
+        # The second request fails fast without trying the host again.
+        eq_(pool.stats()[0]['errors'], 1)
+
+    def test_revive(self):
+        pool = ConnectionPool([self.live], timeout=1)
+        host = pool.hosts[0]
+        pool.mark_dead(host, 'test')
+        eq_(host.alive, False)
+        host.dead_until = 0
+        eq_(self.request(pool)['ok'], True)
+        eq_(host.alive, True)
+
+    def test_stream(self):
+        pool = ConnectionPool([self.live], timeout=1)
+        es = elasticutils.ElasticSearch(['127.0.0.1:9200'])
+        es.connection = pool
+        lines = ['{"a":%d}\n' % i for i in range(20000)]
+        response = es._send_request('POST', '/_bulk', lines)
+        eq_(response['body'], ''.join(lines))
+        eq_(es._send_request('POST', '/_bulk', {'a': 1})['body'], '{"a":1}')
+
+    def test_compress(self):
+        pool = ConnectionPool([self.live], timeout=1, compress=True)
+        es = elasticutils.ElasticSearch(['127.0.0.1:9200'])
+        es.connection = pool
+        lines = ['{"a":%d}\n' % i for i in range(20000)]
+        response = es._send_request('POST', '/_bulk', lines)
+        eq_(response['body'], ''.join(lines))
+        eq_(response['encoding'], 'gzip')
+        stats = pool.stats()[0]
+        assert stats['bytes_sent'] < len(''.join(lines)) / 4
+        assert stats['bytes_received'] < len(''.join(lines)) / 4
+        # Small bodies are sent as they are.
+        response = es._send_request('POST', '/_search', {'a': 1})
+        eq_((response['body'], response['encoding']), ('{"a":1}', None))
+
+    def test_reconnect(self):
+        pool = ConnectionPool([self.live], timeout=1)
+        self.request(pool, '/close')
+        eq_(self.request(pool, '/test')['path'], '/test')
+        eq_(self.server.paths, ['/close', '/test'])
+
+    def test_bad_gzip(self):
+        pool = ConnectionPool([self.live], timeout=1, maxsize=1)
+        for i in range(2):
+            self.assertRaises(zlib.error, self.request, pool, '/badgzip')
+        eq_(self.request(pool)['ok'], True)
+        eq_(pool.stats()[0]['idle_connections'], 1)
+
+    def test_timeout_not_resent(self):
+        pool = ConnectionPool([self.live], timeout=0.2)
+        self.request(pool)
+        start = time.time()
+        try:
+            self.request(pool, '/slow')
+        except ConnectionFailed as e:
+            assert isinstance(e.error, socket.timeout)
+        else:
+            assert False, 'Expected a timeout.'
+        assert time.time() - start < 0.4
+        time.sleep(0.4)
+        eq_(self.server.paths, ['/test/_search', '/slow'])
+
+    def test_timeout_not_retried(self):
+        pool = ConnectionPool([self.live], timeout=0.2)
+        start = time.time()
+        self.assertRaises(ConnectionFailed, with_retries,
+                          lambda: self.request(pool, '/slow'),
+                          retries=2, delay=0.001)
+        assert time.time() - start < 0.4
+        time.sleep(0.4)
+        eq_(self.server.paths, ['/slow'])
+
+    def test_pool_exhausted(self):
+        pool = ConnectionPool([self.live], timeout=0.2, maxsize=1)
+        pool.breaker = CircuitBreaker(min_calls=1)
+        pool.hosts[0]._idle.get()
+        self.assertRaises(PoolExhausted, with_retries,
+                          lambda: self.request(pool), retries=2,
+                          delay=0.001)
+        eq_(self.server.paths, [])
+        eq_(pool.breaker.stats()['calls'], 0)
+        eq_(pool.stats()[0]['errors'], 0)
+
+    def test_hung_node(self):
+        # Accepts connections but never answers.
+        hung = socket.socket()
+        hung.bind(('127.0.0.1', 0))
+        hung.listen(50)
+        try:
+            pool = ConnectionPool(['127.0.0.1:%d' % hung.getsockname()[1],
+                                   self.live], timeout=0.1, max_errors=2)
+            failed = 0
+            for i in range(10):
+                try:
+                    self.request(pool)
+                except ConnectionFailed:
+                    failed += 1
+        finally:
+            hung.close()
+        eq_(failed, 2)
+        hung_stats, live = pool.stats()
+        eq_((hung_stats['alive'], hung_stats['errors']), (False, 2))
+        eq_(live['requests'], 8)
+
+    def test_breaker_one_node_hung(self):
+        hung = socket.socket()
+        hung.bind(('127.0.0.1', 0))
+        hung.listen(50)
+        hung_server = '127.0.0.1:%d' % hung.getsockname()[1]
+        try:
+            pool = ConnectionPool([hung_server, self.live], timeout=0.1,
+                                  max_errors=5)
+            pool.breaker = CircuitBreaker(threshold=0.5, min_calls=4)
+            for i in range(20):
+                try:
+                    self.request(pool)
+                except ConnectionFailed:
+                    pass
+            # The healthy node kept the circuit closed.
+            eq_(pool.breaker.state, 'closed')
+            eq_(pool.stats()[0]['alive'], False)
+
+            pool = ConnectionPool([hung_server], timeout=0.1, max_errors=5)
+            pool.breaker = CircuitBreaker(threshold=0.5, min_calls=4)
+            for i in range(4):
+                self.assertRaises(ConnectionFailed, self.request, pool)
+            eq_(pool.breaker.state, 'open')
+        finally:
+            hung.close()
+
+    def test_least_latency(self):
+        pool = ConnectionPool([self.live, self.live], timeout=1,
+                              selector='least_latency')
+        pool.hosts[0].latency = 1.0
+        self.request(pool)
+        eq_([h.requests for h in pool.hosts], [0, 1])
+
+
+class BreakerTest(TestCase):
+
+    def test_opens(self):
+        breaker = CircuitBreaker(threshold=0.5, min_calls=4, window=30,
+                                 reset_timeout=30)
+        for i in range(2):
+            breaker.before()
+            breaker.success()
+        breaker.before()
+        breaker.failure()
+        eq_(breaker.state, 'closed')
+        breaker.before()
+        breaker.failure()
+        eq_(breaker.state, 'open')
+        eq_(breaker.stats()['error_rate'], 0.5)
+        try:
+            breaker.before()
+        except CircuitOpen:
+            pass
+        else:
+            assert False, 'Expected CircuitOpen.'
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=30)
+        breaker.before()
+        breaker.failure()
+        eq_(breaker.state, 'open')
+        breaker.opened_at -= 30
+        breaker.before()
+        eq_(breaker.state, 'half_open')
+        # Only one trial request at a time.
+        self.assertRaises(CircuitOpen, breaker.before)
+        breaker.success()
+        eq_(breaker.state, 'closed')
+        breaker.before()
+
+    def test_retries(self):
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise socket.error(errno.ECONNRESET, 'Connection reset')
+            return 'ok'
+        eq_(with_retries(flaky, retries=2, delay=0.001), 'ok')
+        eq_(len(calls), 3)
+
+        del calls[:]
+        self.assertRaises(socket.error, with_retries, flaky, retries=1,
+                          delay=0.001)
+        eq_(len(calls), 2)
+
+    def test_no_retry_past_deadline(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise socket.error(errno.ECONNRESET, 'Connection reset')
+        with deadline(0.0001):
+            self.assertRaises(socket.error, with_retries, failing,
+                              retries=5, delay=1)
+        eq_(len(calls), 1)
+
+    def test_transient(self):
+        assert is_transient(socket.error(errno.ECONNREFUSED, 'Refused'))
+        assert is_transient(ConnectionFailed(
+            socket.error(errno.EPIPE, 'Broken pipe')))
+        assert not is_transient(socket.timeout('timed out'))
+        assert not is_transient(ConnectionFailed(socket.timeout('timed out')))
+        assert not is_transient(PoolExhausted('No free connection'))
+        assert not is_transient(ValueError())
+
+    def test_cancel(self):
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=30)
+        breaker.before()
+        breaker.failure()
+        breaker.opened_at -= 30
+        breaker.before()
+        breaker.cancel()
+        eq_(breaker.state, 'half_open')
+        # Another trial request may go.
+        breaker.before()
+
+    def test_pool_budget(self):
+        pool = ConnectionPool(['127.0.0.1:%d' % free_port()])
+        request = RestRequest(method=0, uri='/', parameters={}, headers={},
+                              body='')
+        with deadline(-1):
+            self.assertRaises(socket.timeout, pool.execute, request)
+
+
 class QueryTest(TestCase):
 
     @classmethod